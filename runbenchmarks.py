@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Micro benchmarks of the sensorAtlas hot paths. They use unsaved entities and
+need no database, but GDAL/GEOS must be installed like for the tests.
+
+    python runbenchmarks.py [name ...]
+"""
+import os
+import sys
+import timeit
+
+import django
+
+
+ROWS = 1000
+REPEAT = 5
+
+
+def request():
+    from rest_framework.request import Request
+    from rest_framework.test import APIRequestFactory
+    return Request(APIRequestFactory().get('/api/v1.0/Datastreams'))
+
+
+def datastreams():
+    from django.contrib.gis.geos import Polygon
+    from sensorAtlas.models import Datastream
+    area = Polygon(((0.0, 0.0), (0.0, 50.0), (50.0, 50.0), (50.0, 0.0), (0.0, 0.0)))
+    return [
+        Datastream(
+            id=i,
+            name='Datastream %d' % i,
+            description='A datastream',
+            unitOfMeasurement={'name': 'degree Celsius', 'symbol': 'degC'},
+            observationType='http://www.opengis.net/def/observationType/OGC-OM/2.0/OM_Measurement',
+            observedArea=area
+        )
+        for i in range(1, ROWS + 1)
+    ]
+
+
+def legacy_representation(serializer, obj):
+    """
+    The per-row post-processing of DRF's output that ControlInformation did
+    before its renderer was compiled, kept as the baseline.
+    """
+    import json
+    from rest_framework import serializers
+    data = serializers.ModelSerializer.to_representation(serializer, obj)
+    for key, plural in serializer.plural_keys.get(obj.__class__.__name__, {}).items():
+        if key in data:
+            data[plural] = data.pop(key)
+    data['@iot.selfLink'] = data.pop('selfLink')
+    data.move_to_end('@iot.selfLink', last=False)
+    data['@iot.id'] = data.pop('id')
+    data.move_to_end('@iot.id', last=False)
+    for key, value in data.pop('navigationLinks').items():
+        data[key] = value
+    if obj.observedArea:
+        data['observedArea'] = json.loads(obj.observedArea.geojson)
+    return data
+
+
+def serialization():
+    """
+    Per-row cost of rendering a page of Datastreams, legacy vs compiled.
+    """
+    from sensorAtlas.serializer import DatastreamSerializer
+    rows = datastreams()
+    serializer = DatastreamSerializer(context={'request': request()})
+
+    def legacy():
+        for obj in rows:
+            legacy_representation(serializer, obj)
+
+    def compiled():
+        for obj in rows:
+            serializer.to_representation(obj)
+
+    results = {}
+    for name, function in (('legacy', legacy), ('compiled', compiled)):
+        best = min(timeit.repeat(function, number=1, repeat=REPEAT))
+        results[name] = best
+        print('  %-10s %8.1f us/row' % (name, best / ROWS * 1e6))
+    print('  speedup    %8.1fx' % (results['legacy'] / results['compiled']))
+
+
+BENCHMARKS = {
+    'serialization': serialization,
+}
+
+
+def runbenchmarks(names):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.test_settings')
+    django.setup()
+    for name in names or BENCHMARKS:
+        print(name)
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    runbenchmarks(sys.argv[1:])
@@ -1,6 +1,21 @@
 from django.apps import AppConfig
+from django.core import checks
+from django.core.signals import request_finished
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_delete, post_save
 
 
 class sensorAtlasConfig(AppConfig):
     name = 'sensorAtlas'
     verbose_name = 'Sensor Atlas'
+
+    def ready(self):
+        from .caching import invalidate, invalidate_relation
+        from .replicas import release
+        from .statements import check_persistent_connections, install
+        checks.register(check_persistent_connections)
+        connection_created.connect(install)
+        request_finished.connect(release)
+        post_save.connect(invalidate)
+        post_delete.connect(invalidate)
+        m2m_changed.connect(invalidate_relation)
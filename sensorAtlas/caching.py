@@ -0,0 +1,196 @@
+"""
+Response cache of the entities that rarely change.
+
+GET responses whose path, $expand, $filter, $orderby and $select only
+involve the entities listed in CACHED_ENTITIES, e.g. Things, Sensors,
+ObservedProperties and Locations, are kept in the RESPONSE_CACHE cache (an
+alias of CACHES, e.g. local memory or Redis). They are keyed on the URL of
+the request with its sorted query options, the accepted media type, and the
+generations of the involved entities. The post_save, post_delete and
+m2m_changed signals of an entity bump its generation, which invalidates
+the responses of the entity and of every entity it is navigated or expanded
+from at once.
+
+Cached responses are replayed with their Content-Type, Vary and Allow
+headers and carry an ETag; a request whose If-None-Match matches it gets a
+304 Not Modified response.
+"""
+import hashlib
+import re
+import time
+
+from urllib.parse import parse_qsl
+from django.core.cache import caches
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import parse_etags
+from rest_framework.response import Response
+from .settings import atlas_settings
+
+
+APP_LABEL = 'sensorAtlas'
+GENERATION_KEY = 'sensoratlas:generation:%s'
+RESPONSE_KEY = 'sensoratlas:response:%s'
+NAME = re.compile(r'[A-Za-z]+')
+CACHED_HEADERS = ('Content-Type', 'Vary', 'Allow')
+
+
+def get_cache():
+    return caches[atlas_settings.RESPONSE_CACHE]
+
+
+def involved_entities(request):
+    """
+    Returns the names of the entities the response of a request is made of:
+    those in its path and those named in its query options.
+    """
+    from .viewsets import MODEL_KEYS
+    names = NAME.findall(request.path)
+    for _, value in parse_qsl(request.META.get('QUERY_STRING', ''), keep_blank_values=True):
+        names.extend(NAME.findall(value))
+    return {MODEL_KEYS[name] for name in names if name in MODEL_KEYS}
+
+
+def generations(entities):
+    """
+    Returns the current generation of each entity. A generation missing from
+    the cache, e.g. evicted, starts at the current time, so it never repeats
+    one that responses may still be cached with.
+    """
+    cache = get_cache()
+    keys = {GENERATION_KEY % entity: entity for entity in entities}
+    current = cache.get_many(list(keys))
+    for key in keys:
+        if key not in current:
+            cache.add(key, int(time.time() * 1000), None)
+            current[key] = cache.get(key)
+    return tuple(sorted((keys[key], value) for key, value in current.items()))
+
+
+def bump(entity):
+    cache = get_cache()
+    key = GENERATION_KEY % entity
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, int(time.time() * 1000), None)
+
+
+def response_key(request):
+    """
+    Returns the cache key of the response of a DRF request, or None if it is
+    not cached.
+    """
+    cached = atlas_settings.CACHED_ENTITIES
+    if not cached or request.method != 'GET':
+        return None
+    entities = involved_entities(request)
+    if not entities or not entities.issubset(cached):
+        return None
+    query = sorted(parse_qsl(request.META.get('QUERY_STRING', ''), keep_blank_values=True))
+    key = repr((
+        request.build_absolute_uri(request.path),
+        query,
+        request.accepted_media_type,
+        generations(entities)
+    ))
+    return RESPONSE_KEY % hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def not_modified(request, etag):
+    etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    return etag in etags or '*' in etags
+
+
+def replay_headers(response, headers):
+    """
+    Sets the cached headers of a response on a response served from them. A
+    304 Not Modified response has no content, so it gets no Content-Type.
+    """
+    for header, value in headers.items():
+        if header != 'Content-Type' or response.status_code != 304:
+            response[header] = value
+
+
+class CachedResponse(Exception):
+    """
+    Raised by ResponseCaching.initial with the response of a cache hit, so
+    that the view does not run.
+    """
+    def __init__(self, response):
+        self.response = response
+
+
+class ResponseCaching:
+    """
+    View mixin that answers GET requests from the response cache, once
+    authentication, permissions and content negotiation passed, and caches
+    the responses it renders.
+    """
+    def initial(self, request, *args, **kwargs):
+        self.response_key = None
+        super(ResponseCaching, self).initial(request, *args, **kwargs)
+        key = response_key(request)
+        if key is None:
+            return
+        entry = get_cache().get(key)
+        if entry is None:
+            self.response_key = key
+            return
+        if not_modified(request, entry['etag']):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(entry['content'])
+        replay_headers(response, entry['headers'])
+        response['ETag'] = entry['etag']
+        raise CachedResponse(response)
+
+    def handle_exception(self, exc):
+        if isinstance(exc, CachedResponse):
+            return exc.response
+        return super(ResponseCaching, self).handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(ResponseCaching, self).finalize_response(
+            request, response, *args, **kwargs)
+        key = getattr(self, 'response_key', None)
+        if key is None or not isinstance(response, Response) or \
+                response.status_code != 200:
+            return response
+        response.render()
+        etag = '"%s"' % hashlib.md5(response.content).hexdigest()
+        headers = {
+            header: response[header]
+            for header in CACHED_HEADERS if response.has_header(header)
+        }
+        get_cache().set(key, {
+            'content': response.content,
+            'headers': headers,
+            'etag': etag
+        }, atlas_settings.RESPONSE_CACHE_TIMEOUT)
+        if not_modified(request, etag):
+            response = HttpResponseNotModified()
+            replay_headers(response, headers)
+        response['ETag'] = etag
+        return response
+
+
+def invalidate(sender, **kwargs):
+    """
+    post_save and post_delete receiver that invalidates the cached responses
+    of a changed entity.
+    """
+    if sender._meta.app_label == APP_LABEL and \
+            sender.__name__ in atlas_settings.CACHED_ENTITIES:
+        bump(sender.__name__)
+
+
+def invalidate_relation(sender, instance, action, model, **kwargs):
+    """
+    m2m_changed receiver that invalidates the cached responses of both sides
+    of a changed many-to-many relation, e.g. of Things and Locations.
+    """
+    if not action.startswith('post_') or instance._meta.app_label != APP_LABEL:
+        return
+    for entity in {instance.__class__.__name__, model.__name__}:
+        if entity in atlas_settings.CACHED_ENTITIES:
+            bump(entity)
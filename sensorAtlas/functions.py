@@ -1,8 +1,17 @@
+import functools
 import operator
 
+from django.contrib.gis.db.models import GeometryField
+from django.contrib.gis.gdal import GDALException
+from django.contrib.gis.geos import GEOSException, GEOSGeometry
 from django.db.models import Q, Lookup, Func, CharField, TextField, F, Value
 from django.db.models.fields import FloatField, IntegerField, Field
 from django.db.models.functions import Length, Lower, Upper
+from .settings import atlas_settings
+
+
+# Number of parsed geometry literals kept per process.
+GEOMETRY_CACHE_SIZE = 128
 
 
 class CustomFunctions:
@@ -50,6 +59,82 @@ class CustomFunctions:
         template = "NULLIF(REGEXP_REPLACE((%(expressions)s::json->'result')::text, '^(?![0-9.]*$).+$', '', 'g'), '')::numeric"
 
 
+def result_field(kind):
+    """
+    Returns the lookup of the Observation result for a filter on a value of
+    the given kind ('number', 'text' or 'bool'). With TYPED_RESULTS the typed
+    result column is used, otherwise the key of the JSON result column.
+    """
+    if atlas_settings.TYPED_RESULTS:
+        return 'result_' + kind
+    return 'result__result'
+
+
+def numeric_result(field, function=None):
+    """
+    Returns an expression that reads the Observation result as a number,
+    optionally wrapped in a numeric SQL function (ROUND, FLOOR, CEILING).
+    """
+    if atlas_settings.TYPED_RESULTS:
+        if function:
+            return Func(F('result_number'), function=function.function)
+        return F('result_number')
+    if function:
+        return function(field)
+    return CustomFunctions.NullIf(field)
+
+
+@functools.lru_cache(maxsize=GEOMETRY_CACHE_SIZE)
+def parse_geometry(text):
+    try:
+        return GEOSGeometry(text)
+    except (GEOSException, GDALException):
+        raise ValueError("Couldn't create spatial object from '%s'." % text)
+
+
+def geometry_literal(text):
+    """
+    Returns the GEOS geometry of a geometry literal of a filter, which the
+    query binds as a parameter. The WKT of the literals is parsed once and
+    cached by its text; every query gets its own copy, because Django sets
+    the SRID of the field on geometries without one.
+    """
+    return parse_geometry(text).clone()
+
+
+def field_geometry(field, geometry):
+    """
+    Returns the geometry literal of a spatial function of a field in the SRID
+    of the field, so that the function compares geometries of one SRID
+    whichever the literal is written in.
+    """
+    return Func(
+        Value(geometry, output_field=GeometryField(srid=geometry.srid or 4326)),
+        Func(F(field), function='ST_SRID', output_field=IntegerField()),
+        function='ST_Transform',
+        output_field=GeometryField()
+    )
+
+
+def distance_operands(parameterstring):
+    """
+    Returns the field and the geometry of the parameters of geo.distance.
+    """
+    parsedlist = parameterstring.split(',')
+    # this is not very good ... easy to break
+    point_index = [i for i, s in enumerate(parsedlist) if "POINT" in s]
+    field_index = [i for i, s in enumerate(parsedlist) if s[0] != "'" or s[-1] != "'"]
+
+    string = parsedlist[point_index[0]]
+    try:
+        string = string.split("'")[1]
+    except:
+        pass
+
+    field = parsedlist[field_index[0]]
+    return field, geometry_literal(string)
+
+
 class QueryFunctions:
     """
     Built-in query functions of the Sensor Things API. Most function
@@ -77,7 +162,7 @@ class QueryFunctions:
         field = parsedlist[field_index[0]]
 
         if field == 'result':
-            field = 'result__result'
+            field = result_field('text')
 
         if string[0] == "'" and string[-1] == "'":
             string = string[1:-1]
@@ -97,7 +182,7 @@ class QueryFunctions:
         parsedlist = parameterstring.split(',')
         field = parsedlist[0]
         if field == 'result':
-            field = 'result__result'
+            field = result_field('text')
         string = parsedlist[1]
         if string[0] == "'" and string[-1] == "'":
             string = string[1:-1]
@@ -116,7 +201,7 @@ class QueryFunctions:
         parsedlist = parameterstring.split(',')
         field = parsedlist[0]
         if field == 'result':
-            field = 'result__result'
+            field = result_field('text')
         string = parsedlist[1]
         if string[0] == "'" and string[-1] == "'":
             string = string[1:-1]
@@ -134,7 +219,7 @@ class QueryFunctions:
         django_function = '__length'
         field = parameterstring
         if field == 'result':
-            field = 'result__result'
+            field = result_field('text')
         d = dict()
         d['query_field'] = field + django_function
         return d
@@ -147,7 +232,7 @@ class QueryFunctions:
         django_function = '__lower'
         field = parameterstring
         if field == 'result':
-            field = 'result__result'
+            field = result_field('text')
         d = dict()
         d['query_field'] = field + django_function
         return d
@@ -160,7 +245,7 @@ class QueryFunctions:
         django_function = '__upper'
         field = parameterstring
         if field == 'result':
-            field = 'result__result'
+            field = result_field('text')
         d = dict()
         d['query_field'] = field + django_function
         return d
@@ -262,7 +347,10 @@ class QueryFunctions:
         field = parameterstring
         temporary_field = "temp" + str(kwargs['index'])
         d['query_field'] = temporary_field
-        d['annotation'] = {temporary_field: django_function(field)}
+        if field == 'result':
+            d['annotation'] = {temporary_field: numeric_result(field, django_function)}
+        else:
+            d['annotation'] = {temporary_field: django_function(field)}
         return d
 
     def floor(parameterstring, **kwargs):
@@ -271,7 +359,10 @@ class QueryFunctions:
         field = parameterstring
         temporary_field = "temp" + str(kwargs['index'])
         d['query_field'] = temporary_field
-        d['annotation'] = {temporary_field: django_function(field)}
+        if field == 'result':
+            d['annotation'] = {temporary_field: numeric_result(field, django_function)}
+        else:
+            d['annotation'] = {temporary_field: django_function(field)}
         return d
 
     def ceiling(parameterstring, **kwargs):
@@ -280,28 +371,41 @@ class QueryFunctions:
         field = parameterstring
         temporary_field = "temp" + str(kwargs['index'])
         d['query_field'] = temporary_field
-        d['annotation'] = {temporary_field: django_function(field)}
+        if field == 'result':
+            d['annotation'] = {temporary_field: numeric_result(field, django_function)}
+        else:
+            d['annotation'] = {temporary_field: django_function(field)}
         return d
 
     def geo_distance(parameterstring, **kwargs):
         d = dict()
         django_function = CustomFunctions.ST_Distance
-        parsedlist = parameterstring.split(',')
-        # this is not very good ... easy to break
-        point_index = [i for i, s in enumerate(parsedlist) if "POINT" in s]
-        field_index = [i for i, s in enumerate(parsedlist) if s[0] != "'" or s[-1] != "'"]
-
-        string = parsedlist[point_index[0]]
-        try:
-            string = string.split("'")[1]
-        except:
-            pass
-
-        field = parsedlist[field_index[0]]
-
+        field, geometry = distance_operands(parameterstring)
         temporary_field = "temp" + str(kwargs['index'])
         d['query_field'] = temporary_field
-        d['annotation'] = {temporary_field: django_function(field, Value(string))}
+        d['annotation'] = {
+            temporary_field: django_function(field, field_geometry(field, geometry))
+        }
+        return d
+
+    def geo_within_distance(parameterstring, comparison, distance, **kwargs):
+        """
+        geo.distance(field, geometry) lt / le distance as ST_DWithin, which
+        can use the spatial index of the field. ST_DWithin includes the
+        geometries at exactly the distance, so lt also compares the distance
+        of the rows it finds.
+        """
+        d = dict()
+        field, geometry = distance_operands(parameterstring)
+        query = Q(**{field + '__dwithin': (geometry, distance)})
+        if comparison == 'lt':
+            temporary_field = "temp" + str(kwargs['index'])
+            d['annotation'] = {
+                temporary_field: CustomFunctions.ST_Distance(
+                    field, field_geometry(field, geometry))
+            }
+            query &= Q(**{temporary_field + '__lt': distance})
+        d['query'] = query
         return d
 
     def geo_length(parameterstring, **kwargs):
@@ -316,7 +420,7 @@ class QueryFunctions:
     def st_equals(parameterstring, **kwargs):
         django_function = '__equals'
         field = parameterstring.split(',')[0]
-        geometry = parameterstring.split("'")[1]
+        geometry = geometry_literal(parameterstring.split("'")[1])
         if field == 'result':
             field = 'result__result'
         d = dict()
@@ -326,7 +430,7 @@ class QueryFunctions:
     def st_within(parameterstring, **kwargs):
         django_function = '__within'
         field = parameterstring.split(',')[0]
-        geometry = parameterstring.split("'")[1]
+        geometry = geometry_literal(parameterstring.split("'")[1])
         if field == 'result':
             field = 'result__result'
         d = dict()
@@ -336,7 +440,7 @@ class QueryFunctions:
     def st_disjoint(parameterstring, **kwargs):
         django_function = '__disjoint'
         field = parameterstring.split(',')[0]
-        geometry = parameterstring.split("'")[1]
+        geometry = geometry_literal(parameterstring.split("'")[1])
         if field == 'result':
             field = 'result__result'
         d = dict()
@@ -346,7 +450,7 @@ class QueryFunctions:
     def st_touches(parameterstring, **kwargs):
         django_function = '__touches'
         field = parameterstring.split(',')[0]
-        geometry = parameterstring.split("'")[1]
+        geometry = geometry_literal(parameterstring.split("'")[1])
         if field == 'result':
             field = 'result__result'
         d = dict()
@@ -356,7 +460,7 @@ class QueryFunctions:
     def st_overlaps(parameterstring, **kwargs):
         django_function = '__overlaps'
         field = parameterstring.split(',')[0]
-        geometry = parameterstring.split("'")[1]
+        geometry = geometry_literal(parameterstring.split("'")[1])
         if field == 'result':
             field = 'result__result'
         d = dict()
@@ -366,7 +470,7 @@ class QueryFunctions:
     def st_intersects(parameterstring, **kwargs):
         django_function = '__intersects'
         field = parameterstring.split(',')[0]
-        geometry = parameterstring.split("'")[1]
+        geometry = geometry_literal(parameterstring.split("'")[1])
         if field == 'result':
             field = 'result__result'
         d = dict()
@@ -376,7 +480,7 @@ class QueryFunctions:
     def st_contains(parameterstring, **kwargs):
         django_function = '__contains'
         field = parameterstring.split(',')[0]
-        geometry = parameterstring.split("'")[1]
+        geometry = geometry_literal(parameterstring.split("'")[1])
         if field == 'result':
             field = 'result__result'
         d = dict()
@@ -386,7 +490,7 @@ class QueryFunctions:
     def st_crosses(parameterstring, **kwargs):
         django_function = '__crosses'
         field = parameterstring.split(',')[0]
-        geometry = parameterstring.split("'")[1]
+        geometry = geometry_literal(parameterstring.split("'")[1])
         if field == 'result':
             field = 'result__result'
         d = dict()
@@ -396,7 +500,7 @@ class QueryFunctions:
     def st_relate(parameterstring, **kwargs):
         django_function = '__relate'
         field = parameterstring.split(',')[0]
-        geometry = parameterstring.split("'")[1]
+        geometry = geometry_literal(parameterstring.split("'")[1])
         intersection = parameterstring.split(",")[-1]
         intersection = intersection.split("'")[1]
         if field == 'result':
@@ -481,8 +585,7 @@ class QueryOperations:
                 num = float(arguments[1])
                 field = arguments[0]
             if field == 'result':
-                field = 'result__result'
-                value = operator.add(CustomFunctions.NullIf(field), num)
+                value = operator.add(numeric_result(field), num)
             else:
                 value = operator.add(F(field), num)
             temporary_field = "temp" + str(kwargs['index'])
@@ -505,8 +608,7 @@ class QueryOperations:
                 num = float(arguments[1])
                 field = arguments[0]
             if field == 'result':
-                field = 'result__result'
-                value = operator.sub(CustomFunctions.NullIf(field), num)
+                value = operator.sub(numeric_result(field), num)
             else:
                 value = operator.sub(F(field), num)
             temporary_field = "temp" + str(kwargs['index'])
@@ -529,8 +631,7 @@ class QueryOperations:
                 num = float(arguments[1])
                 field = arguments[0]
             if field == 'result':
-                field = 'result__result'
-                value = operator.mul(CustomFunctions.NullIf(field), num)
+                value = operator.mul(numeric_result(field), num)
             else:
                 value = operator.mul(F(field), num)
             temporary_field = "temp" + str(kwargs['index'])
@@ -553,8 +654,7 @@ class QueryOperations:
                 num = float(arguments[1])
                 field = arguments[0]
             if field == 'result':
-                field = 'result__result'
-                value = operator.truediv(CustomFunctions.NullIf(field), num)
+                value = operator.truediv(numeric_result(field), num)
             else:
                 value = operator.truediv(F(field), num)
             temporary_field = "temp" + str(kwargs['index'])
@@ -577,8 +677,7 @@ class QueryOperations:
                 num = float(arguments[1])
                 field = arguments[0]
             if field == 'result':
-                field = 'result__result'
-                value = operator.mod(CustomFunctions.NullIf(field), num)
+                value = operator.mod(numeric_result(field), num)
             else:
                 value = operator.mul(F(field), num)
             temporary_field = "temp" + str(kwargs['index'])
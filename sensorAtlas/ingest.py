@@ -0,0 +1,382 @@
+"""
+Bulk creation of Observations.
+
+create_observations implements the CreateObservations request of the
+SensorThings API dataArray extension, which posts the Observations of one or
+more Datastreams as arrays of values:
+
+[
+    {
+        "Datastream": {"@iot.id": 1},
+        "components": ["phenomenonTime", "result", "FeatureOfInterest/id"],
+        "dataArray@iot.count": 2,
+        "dataArray": [
+            ["2017-02-07T18:02:00.000Z", 21.6, 1],
+            ["2017-02-07T18:03:00.000Z", 21.7, 1]
+        ]
+    }
+]
+
+ObservationLoader streams large loads of CSV or NDJSON observations into the
+database with COPY FROM STDIN.
+"""
+import csv
+import io
+import json
+import dateutil.parser
+from django.db import connection, transaction
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from .models import Datastream, FeatureOfInterest, Observation, typed_result
+from .errors import BadRequest, NotImplemented501, Unprocessable
+from .settings import atlas_settings
+from .viewsets import featureofinterest_from_location, normalize_result, \
+    parse_interval_time
+
+
+DATA_ARRAY_COMPONENTS = (
+    'phenomenonTime',
+    'result',
+    'resultTime',
+    'resultQuality',
+    'parameters',
+    'FeatureOfInterest/id'
+)
+BATCH_SIZE = 1000
+FEATURE_CACHE_SIZE = 100000
+
+
+def parse_time(value):
+    """
+    Returns the aware datetime of an ISO 8601 time. Naive times are taken to
+    be in the current time zone.
+    """
+    time = dateutil.parser.parse(value)
+    if timezone.is_naive(time):
+        time = timezone.make_aware(time)
+    return time
+
+
+def parse_id(value):
+    """
+    Returns an @iot.id as an integer, or None if it is not one.
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def data_array_observations(entry):
+    """
+    Validates the dataArray of one Datastream and returns an unsaved
+    Observation for every row, or None for rows that are not valid. Must be
+    called in the transaction that saves the Observations, since rows without
+    a FeatureOfInterest/id share one created from the Location of the Thing.
+    """
+    try:
+        datastream_id = parse_id(entry['Datastream']['@iot.id'])
+        components = entry['components']
+        rows = entry['dataArray']
+    except (KeyError, TypeError):
+        raise BadRequest()
+
+    if not isinstance(components, list) or not isinstance(rows, list):
+        raise BadRequest()
+    if 'result' not in components or \
+            not set(components).issubset(DATA_ARRAY_COMPONENTS):
+        raise BadRequest()
+    if entry.get('dataArray@iot.count', len(rows)) != len(rows):
+        raise BadRequest()
+
+    datastream = get_object_or_404(Datastream, id=datastream_id)
+
+    rows = [
+        dict(zip(components, row))
+        if isinstance(row, list) and len(row) == len(components) else None
+        for row in rows
+    ]
+
+    if 'FeatureOfInterest/id' in components:
+        feature_ids = {
+            parse_id(row['FeatureOfInterest/id']) for row in rows if row
+        }
+        existing = set(
+            FeatureOfInterest.objects.filter(
+                id__in=[i for i in feature_ids if i is not None]
+            ).values_list('id', flat=True)
+        )
+    # one FeatureOfInterest for the whole array instead of one per row,
+    # created with the first valid row so invalid arrays leave no orphan
+    featureofinterest = None
+
+    now = timezone.now()
+    observations = []
+    for row in rows:
+        if row is None:
+            observations.append(None)
+            continue
+        try:
+            observation = Observation(
+                Datastream=datastream,
+                result=row['result'],
+                phenomenonTime=parse_time(row['phenomenonTime'])
+                if row.get('phenomenonTime') else now,
+                resultTime=parse_time(row['resultTime'])
+                if row.get('resultTime') else None,
+                resultQuality=row.get('resultQuality'),
+                parameters=row.get('parameters')
+            )
+        except (ValueError, OverflowError, TypeError):
+            observations.append(None)
+            continue
+
+        if 'FeatureOfInterest/id' in components:
+            feature_id = parse_id(row['FeatureOfInterest/id'])
+            if feature_id not in existing:
+                observations.append(None)
+                continue
+            observation.FeatureOfInterest_id = feature_id
+        else:
+            if featureofinterest is None:
+                featureofinterest = featureofinterest_from_location(datastream)
+            observation.FeatureOfInterest = featureofinterest
+
+        observation.prepare_result()
+        observations.append(observation)
+    return observations
+
+
+def create_observations(data):
+    """
+    Creates the Observations of a CreateObservations request with a single
+    bulk insert. Returns, per row, the created Observation or None if the row
+    was not valid.
+    """
+    if not isinstance(data, list):
+        raise BadRequest()
+
+    with transaction.atomic():
+        observations = []
+        for entry in data:
+            observations.extend(data_array_observations(entry))
+        Observation.objects.bulk_create(
+            [observation for observation in observations if observation],
+            batch_size=BATCH_SIZE
+        )
+    return observations
+
+
+def copy_field(value):
+    """
+    Returns a value as a COPY csv field. NULL is an unquoted empty field and
+    every other non-numeric value is quoted, so that no text can be read back
+    as NULL.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, (bool, int, float)):
+        return str(value)
+    return '"%s"' % str(value).replace('"', '""')
+
+
+def json_value(value):
+    """
+    Returns the JSON value of a CSV field, or the field itself if it is not
+    JSON (e.g. an unquoted category result).
+    """
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def read_csv(lines):
+    """
+    Yields the rows of CSV observations. The header names the columns with
+    the dataArray components, plus Datastream/id.
+    """
+    for row in csv.DictReader(lines):
+        row = {k: v for k, v in row.items() if k and v != ''}
+        for key in ('result', 'resultQuality', 'parameters'):
+            if key in row:
+                row[key] = json_value(row[key])
+        yield row
+
+
+def read_ndjson(lines):
+    """
+    Yields the rows of newline delimited JSON observations. Related entities
+    are given as {"@iot.id": id} like in a POST of an Observation.
+    """
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield None
+            continue
+        if not isinstance(row, dict):
+            yield None
+            continue
+        for entity in ('Datastream', 'FeatureOfInterest'):
+            if isinstance(row.get(entity), dict):
+                row[entity + '/id'] = row.pop(entity).get('@iot.id')
+        yield {k: v for k, v in row.items() if v is not None}
+
+
+READERS = {
+    'csv': read_csv,
+    'ndjson': read_ndjson
+}
+
+
+class ObservationLoader:
+    """
+    Streams Observations into the database with COPY FROM STDIN.
+
+    Rows are read lazily and copied in chunks, so memory use does not depend
+    on the size of the input. The Datastreams and FeaturesOfInterest of a
+    chunk are resolved with one query each before it is copied. The whole
+    load runs in one transaction: an invalid row fails the load unless
+    skip_invalid is set, in which case it is counted and left out.
+    """
+    columns = (
+        'phenomenonTime',
+        'result',
+        'resultTime',
+        'resultQuality',
+        'parameters',
+        'Datastream_id',
+        'FeatureOfInterest_id',
+        'result_number',
+        'result_text',
+        'result_bool'
+    )
+
+    def __init__(self, skip_invalid=False, chunk_size=None):
+        self.skip_invalid = skip_invalid
+        self.chunk_size = chunk_size or atlas_settings.COPY_CHUNK_SIZE
+        self.datastreams = {}
+        self.features = set()
+        self.default_features = {}
+        self.created = 0
+        self.skipped = 0
+
+    def load(self, lines, format='csv'):
+        """
+        Loads the observations of an iterable of text lines in the given
+        format and returns the number of created Observations.
+        """
+        with connection.cursor() as cursor:
+            if not hasattr(cursor, 'copy_expert'):
+                raise NotImplemented501(
+                    'Loading Observations with COPY requires the psycopg2 '
+                    'database driver.'
+                )
+        rows = READERS[format](lines)
+        with transaction.atomic():
+            chunk = []
+            for number, row in enumerate(rows, 1):
+                chunk.append((number, row))
+                if len(chunk) == self.chunk_size:
+                    self.copy(chunk)
+                    chunk = []
+            if chunk:
+                self.copy(chunk)
+        return self.created
+
+    def resolve(self, chunk):
+        """
+        Looks up the Datastreams and FeaturesOfInterest of a chunk that have
+        not been seen yet.
+        """
+        rows = [row for number, row in chunk if row]
+        datastream_ids = {parse_id(row.get('Datastream/id')) for row in rows}
+        datastream_ids -= set(self.datastreams) | {None}
+        if datastream_ids:
+            self.datastreams.update(
+                Datastream.objects.filter(
+                    id__in=datastream_ids
+                ).values_list('id', 'observationType')
+            )
+
+        feature_ids = {parse_id(row.get('FeatureOfInterest/id')) for row in rows}
+        feature_ids -= self.features | {None}
+        if feature_ids:
+            if len(self.features) > FEATURE_CACHE_SIZE:
+                self.features = set()
+            self.features.update(
+                FeatureOfInterest.objects.filter(
+                    id__in=feature_ids
+                ).values_list('id', flat=True)
+            )
+
+    def default_feature(self, datastream_id):
+        if datastream_id not in self.default_features:
+            datastream = Datastream.objects.get(id=datastream_id)
+            featureofinterest = featureofinterest_from_location(datastream)
+            self.default_features[datastream_id] = featureofinterest.id
+        return self.default_features[datastream_id]
+
+    def values(self, row):
+        """
+        Returns the COPY csv line of a row, normalised like the result and
+        times of a POST of an Observation.
+        """
+        datastream_id = parse_id(row.get('Datastream/id'))
+        if datastream_id not in self.datastreams:
+            raise ValueError('Datastream not found.')
+        if 'FeatureOfInterest/id' in row:
+            feature_id = parse_id(row['FeatureOfInterest/id'])
+            if feature_id not in self.features:
+                raise ValueError('FeatureOfInterest not found.')
+        else:
+            feature_id = self.default_feature(datastream_id)
+
+        row = normalize_result(parse_interval_time(row))
+        typed = typed_result(row['result']['result'], self.datastreams[datastream_id])
+        values = [
+            parse_time(row['phenomenonTime'])
+            if 'phenomenonTime' in row else timezone.now(),
+            json.dumps(row['result']),
+            parse_time(row['resultTime']) if 'resultTime' in row else None,
+            json.dumps(row['resultQuality']) if 'resultQuality' in row else None,
+            json.dumps(row['parameters']) if 'parameters' in row else None,
+            datastream_id,
+            feature_id,
+            typed['result_number'],
+            typed['result_text'],
+            typed['result_bool']
+        ]
+        return ','.join(copy_field(value) for value in values) + '\n'
+
+    def copy(self, chunk):
+        self.resolve(chunk)
+        buffer = io.StringIO()
+        count = 0
+        for number, row in chunk:
+            try:
+                if row is None:
+                    raise ValueError('Not a valid row.')
+                buffer.write(self.values(row))
+                count += 1
+            except (BadRequest, Unprocessable, ValueError, TypeError,
+                    AttributeError, OverflowError) as e:
+                if not self.skip_invalid:
+                    raise Unprocessable('Line %d is not a valid Observation: %s' % (number, e))
+                self.skipped += 1
+
+        if count:
+            qn = connection.ops.quote_name
+            buffer.seek(0)
+            with connection.cursor() as cursor:
+                cursor.copy_expert(
+                    "COPY %s (%s) FROM STDIN WITH (FORMAT csv)" % (
+                        qn(Observation._meta.db_table),
+                        ', '.join(qn(column) for column in self.columns)
+                    ),
+                    buffer
+                )
+            self.created += count
@@ -0,0 +1,62 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from sensorAtlas.errors import NotImplemented501, Unprocessable
+from sensorAtlas.ingest import ObservationLoader, READERS
+
+
+class Command(BaseCommand):
+    """
+    Loads a CSV or NDJSON file of Observations with COPY FROM STDIN. The file
+    is read line by line, so it can be larger than the available memory.
+
+    A CSV file has a header row naming the columns, e.g.
+
+    Datastream/id,phenomenonTime,result,FeatureOfInterest/id
+    1,2017-02-07T18:02:00.000Z,21.6,1
+
+    An NDJSON file has one Observation per line, as it would be posted:
+
+    {"Datastream": {"@iot.id": 1}, "phenomenonTime": "2017-02-07T18:02:00.000Z", "result": 21.6}
+    """
+    help = 'Loads Observations from a CSV or NDJSON file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path',
+            help='Path of the file to load, or - to read from stdin.'
+        )
+        parser.add_argument(
+            '--format',
+            choices=sorted(READERS),
+            default='csv',
+            help='Format of the file.'
+        )
+        parser.add_argument(
+            '--skip-invalid',
+            action='store_true',
+            help='Skip invalid rows instead of aborting the load.'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=None,
+            help='Number of rows copied per COPY statement.'
+        )
+
+    def handle(self, *args, **options):
+        loader = ObservationLoader(
+            skip_invalid=options['skip_invalid'],
+            chunk_size=options['chunk_size']
+        )
+        try:
+            if options['path'] == '-':
+                loader.load(sys.stdin, options['format'])
+            else:
+                with open(options['path'], newline='') as lines:
+                    loader.load(lines, options['format'])
+        except (NotImplemented501, Unprocessable) as e:
+            raise CommandError(e.detail)
+
+        self.stdout.write('Loaded %d observations, skipped %d.' % (
+            loader.created, loader.skipped))
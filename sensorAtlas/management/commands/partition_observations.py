@@ -0,0 +1,318 @@
+import re
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from sensorAtlas.models import Observation
+from sensorAtlas.settings import atlas_settings
+
+
+PARTITION_KEY = 'phenomenonTime'
+
+
+def add_months(month, count):
+    """
+    Returns the first day of the month `count` months after `month`.
+    """
+    index = month.year * 12 + month.month - 1 + count
+    return month.replace(year=index // 12, month=index % 12 + 1, day=1)
+
+
+def month_bounds(month):
+    """
+    Returns the start and the end of the range partition of a month, in UTC.
+    """
+    return (
+        '%s 00:00:00+00' % month.isoformat(),
+        '%s 00:00:00+00' % add_months(month, 1).isoformat()
+    )
+
+
+def partition_constraint():
+    """
+    Returns the SQL of the partition constraint of a month, with the
+    placeholders of its start and end. ATTACH skips scanning a table whose
+    CHECK constraints imply that all its rows belong to the partition, and
+    the default partition if they imply none does.
+    """
+    qn = connection.ops.quote_name
+    key = qn(PARTITION_KEY)
+    return "%s IS NOT NULL AND %s >= %%s::timestamptz AND %s < %%s::timestamptz" % (
+        key, key, key)
+
+
+class Command(BaseCommand):
+    """
+    Maintains monthly range partitions of the Observation table on
+    phenomenonTime.
+
+    --convert turns the existing table into a partitioned table once: the
+    rows of the old table are copied into the partitions of their months in
+    one pass, and the emptied old table is attached as the default
+    partition. Afterwards, run the command
+    regularly (e.g. daily from cron) to create the partitions of the coming
+    months, and of the months of rows that landed in the default partition,
+    and to detach and drop partitions that are older than the retention
+    period.
+    """
+    help = 'Creates and expires monthly partitions of the Observation table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--convert',
+            action='store_true',
+            help='Convert the Observation table into a partitioned table.'
+        )
+        parser.add_argument(
+            '--premake',
+            type=int,
+            default=atlas_settings.PARTITION_PREMAKE,
+            help='Number of future monthly partitions to create.'
+        )
+        parser.add_argument(
+            '--retention',
+            type=int,
+            default=atlas_settings.PARTITION_RETENTION,
+            help='Number of past months to keep. Older partitions are '
+                 'detached and dropped.'
+        )
+        parser.add_argument(
+            '--detach-only',
+            action='store_true',
+            help='Detach expired partitions without dropping them.'
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Partitioning requires a PostgreSQL database.')
+
+        self.table = Observation._meta.db_table
+        self.default = self.table + '_default'
+
+        if options['convert']:
+            self.convert()
+        elif not self.is_partitioned():
+            raise CommandError(
+                '%s is not partitioned. Run with --convert first.' % self.table
+            )
+
+        this_month = timezone.now().date().replace(day=1)
+        months = set(self.default_months())
+        months.update(add_months(this_month, i) for i in range(options['premake'] + 1))
+        for month in sorted(months):
+            self.create_partition(month)
+
+        if options['retention'] is not None:
+            cutoff = add_months(this_month, -options['retention'])
+            for name, month in self.partitions():
+                if add_months(month, 1) <= cutoff:
+                    self.expire_partition(name, options['detach_only'])
+
+    def is_partitioned(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT relkind FROM pg_class WHERE oid = %s::regclass",
+                [connection.ops.quote_name(self.table)]
+            )
+            return cursor.fetchone()[0] == 'p'
+
+    def default_months(self):
+        """
+        Returns the months of the rows in the default partition, i.e. of rows
+        written before the partition of their month existed, so that they
+        are split out into monthly partitions, where retention and pruning
+        apply.
+        """
+        return self.months(self.default)
+
+    def months(self, table):
+        qn = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT DISTINCT date_trunc('month', %s AT TIME ZONE 'UTC') "
+                "FROM %s WHERE %s IS NOT NULL" % (
+                    qn(PARTITION_KEY), qn(table), qn(PARTITION_KEY))
+            )
+            return sorted(row[0].date() for row in cursor.fetchall())
+
+    def partition_name(self, month):
+        return '%s_p%04d_%02d' % (self.table, month.year, month.month)
+
+    def create_month_table(self, cursor, name, start, end):
+        """
+        Creates the table of a monthly partition with the CHECK constraint
+        of its range, added while the table is empty so that the rows are
+        checked as they are inserted instead of by a scan.
+        """
+        qn = connection.ops.quote_name
+        cursor.execute(
+            "CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS)" % (
+                qn(name), qn(self.table))
+        )
+        cursor.execute(
+            "ALTER TABLE %s ADD CONSTRAINT %s CHECK (%s)" % (
+                qn(name), qn(name + '_check'), partition_constraint()),
+            [start, end]
+        )
+
+    def attach_month_table(self, cursor, name, start, end):
+        qn = connection.ops.quote_name
+        cursor.execute(
+            "ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (%%s) TO (%%s)" % (
+                qn(self.table), qn(name)),
+            [start, end]
+        )
+        cursor.execute("ALTER TABLE %s DROP CONSTRAINT %s" % (
+            qn(name), qn(name + '_check')))
+
+    def partitions(self):
+        """
+        Returns the (name, month) of the monthly partitions.
+        """
+        pattern = re.compile(re.escape(self.table) + r'_p(\d{4})_(\d{2})$')
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = %s::regclass",
+                [connection.ops.quote_name(self.table)]
+            )
+            names = [row[0] for row in cursor.fetchall()]
+        partitions = []
+        for name in names:
+            match = pattern.match(name)
+            if match:
+                month = datetime(int(match.group(1)), int(match.group(2)), 1).date()
+                partitions.append((name, month))
+        return sorted(partitions, key=lambda partition: partition[1])
+
+    @transaction.atomic
+    def convert(self):
+        if self.is_partitioned():
+            raise CommandError('%s is already partitioned.' % self.table)
+
+        qn = connection.ops.quote_name
+        table = qn(self.table)
+        with connection.cursor() as cursor:
+            # Move the indexes of the old table out of the way so the
+            # partitioned table can take over their names.
+            cursor.execute(
+                "SELECT i.relname, pg_get_indexdef(i.oid), c.conname "
+                "FROM pg_index x "
+                "JOIN pg_class i ON i.oid = x.indexrelid "
+                "LEFT JOIN pg_constraint c ON c.conindid = x.indexrelid "
+                "AND c.contype IN ('p', 'u') "
+                "WHERE x.indrelid = %s::regclass",
+                [connection.ops.quote_name(self.table)]
+            )
+            indexes = cursor.fetchall()
+            cursor.execute("ALTER TABLE %s RENAME TO %s" % (table, qn(self.default)))
+            for name, definition, constraint in indexes:
+                if constraint:
+                    cursor.execute("ALTER TABLE %s RENAME CONSTRAINT %s TO %s" % (
+                        qn(self.default), qn(constraint), qn(constraint + '_default')))
+                else:
+                    cursor.execute("ALTER INDEX %s RENAME TO %s" % (
+                        qn(name), qn(name + '_default')))
+
+            cursor.execute(
+                "CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING IDENTITY "
+                "INCLUDING CONSTRAINTS INCLUDING STORAGE) "
+                "PARTITION BY RANGE (%s)" % (
+                    table, qn(self.default), qn(PARTITION_KEY))
+            )
+            # A unique constraint on a partitioned table has to include the
+            # partition key.
+            cursor.execute("ALTER TABLE %s ADD PRIMARY KEY (id, %s)" % (
+                table, qn(PARTITION_KEY)))
+            # The index definitions still refer to the table by its name,
+            # which is now the partitioned table. Matching indexes of the old
+            # table are attached to them instead of being rebuilt.
+            for name, definition, constraint in indexes:
+                if not constraint:
+                    cursor.execute(definition)
+            for field in Observation._meta.concrete_fields:
+                if field.remote_field:
+                    cursor.execute(
+                        "ALTER TABLE %s ADD FOREIGN KEY (%s) REFERENCES %s (%s) "
+                        "DEFERRABLE INITIALLY DEFERRED" % (
+                            table,
+                            qn(field.column),
+                            qn(field.related_model._meta.db_table),
+                            qn(field.target_field.column)
+                        )
+                    )
+            # An identity column gets a new sequence on the new table, which
+            # has to continue from the existing ids.
+            cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+            sequence = cursor.fetchone()[0]
+            if sequence:
+                cursor.execute(
+                    "SELECT setval(%%s, COALESCE(MAX(id), 0) + 1, false) FROM %s" % (
+                        qn(self.default)),
+                    [sequence]
+                )
+            # Copy the rows of every month into its partition, then empty the
+            # old table at once, instead of moving the months out of the
+            # default partition one by one, which would scan all of it and
+            # validate a constraint on it for every month.
+            months = self.months(self.default)
+            for month in months:
+                name = self.partition_name(month)
+                start, end = month_bounds(month)
+                self.create_month_table(cursor, name, start, end)
+                cursor.execute(
+                    "INSERT INTO %s SELECT * FROM %s WHERE %s >= %%s AND %s < %%s" % (
+                        qn(name), qn(self.default), qn(PARTITION_KEY), qn(PARTITION_KEY)),
+                    [start, end]
+                )
+                # There is no default partition yet to scan.
+                self.attach_month_table(cursor, name, start, end)
+            cursor.execute("TRUNCATE %s" % qn(self.default))
+            cursor.execute("ALTER TABLE %s ATTACH PARTITION %s DEFAULT" % (
+                table, qn(self.default)))
+        self.stdout.write('Converted %s into a partitioned table with %d monthly partitions.' % (
+            self.table, len(months)))
+
+    @transaction.atomic
+    def create_partition(self, month):
+        name = self.partition_name(month)
+        if name in [partition[0] for partition in self.partitions()]:
+            return
+
+        qn = connection.ops.quote_name
+        start, end = month_bounds(month)
+        check = qn(name + '_check')
+        with connection.cursor() as cursor:
+            self.create_month_table(cursor, name, start, end)
+            # Rows of this month that were written before the partition
+            # existed are in the default partition and have to move first.
+            cursor.execute(
+                "WITH moved AS (DELETE FROM %s WHERE %s >= %%s AND %s < %%s "
+                "RETURNING *) INSERT INTO %s SELECT * FROM moved" % (
+                    qn(self.default), qn(PARTITION_KEY), qn(PARTITION_KEY), qn(name)),
+                [start, end]
+            )
+            # Validated by a scan of the default partition, which only holds
+            # the rows of months that had no partition yet: --convert
+            # leaves it empty.
+            cursor.execute(
+                "ALTER TABLE %s ADD CONSTRAINT %s CHECK (NOT (%s))" % (
+                    qn(self.default), check, partition_constraint()),
+                [start, end]
+            )
+            self.attach_month_table(cursor, name, start, end)
+            cursor.execute("ALTER TABLE %s DROP CONSTRAINT %s" % (qn(self.default), check))
+        self.stdout.write('Created partition %s.' % name)
+
+    @transaction.atomic
+    def expire_partition(self, name, detach_only):
+        qn = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute("ALTER TABLE %s DETACH PARTITION %s" % (
+                qn(self.table), qn(name)))
+            if not detach_only:
+                cursor.execute("DROP TABLE %s" % qn(name))
+        self.stdout.write('%s partition %s.' % (
+            'Detached' if detach_only else 'Dropped', name))
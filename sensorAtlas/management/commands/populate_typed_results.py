@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from sensorAtlas.models import Observation, typed_result
+
+
+class Command(BaseCommand):
+    """
+    Copies the JSON result of existing Observations into the typed result
+    columns. Run this once before enabling the TYPED_RESULTS setting on a
+    database that already holds observations.
+    """
+    help = 'Populates the typed result columns of existing Observations.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Number of observations updated per query.'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        columns = ['result_number', 'result_text', 'result_bool']
+        queryset = Observation.objects.only(
+            'id', 'result', 'Datastream__observationType'
+        ).select_related('Datastream').order_by('id')
+
+        batch = []
+        updated = 0
+        for observation in queryset.iterator(chunk_size=batch_size):
+            values = typed_result(
+                observation.result.get('result'),
+                observation.Datastream.observationType
+            )
+            for column, value in values.items():
+                setattr(observation, column, value)
+            batch.append(observation)
+            if len(batch) == batch_size:
+                Observation.objects.bulk_update(batch, columns)
+                updated += len(batch)
+                batch = []
+        if batch:
+            Observation.objects.bulk_update(batch, columns)
+            updated += len(batch)
+
+        self.stdout.write('Updated %d observations.' % updated)
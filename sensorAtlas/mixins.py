@@ -1,11 +1,57 @@
+from collections import OrderedDict
 from expander import ExpanderSerializerMixin
 from rest_framework import serializers
-from .utils import dict_from_qs, qs_from_dict
+from rest_framework.fields import SkipField
+from django.contrib.gis.db.models import GeometryField
+from django.contrib.gis.geos import GeometryCollection, MultiLineString, \
+    MultiPoint, MultiPolygon
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+from .utils import PREFETCH_SLICING, expand_page, parse_expand
 from .errors import Conflicts, NotImplemented501
-from .parsers import CustomParser
+from .parsers import CustomParser, PagedQuerySet
 from rest_framework.reverse import reverse
-import json
-from .models import Datastream
+from .models import Observation
+from .projection import GEOJSON, project_values
+from .renderers import raw_json
+from .viewsets import MODEL_KEYS
+
+
+# Placeholder for the entity id in the reversed link templates.
+LINK_ID = 'sensorAtlasLinkId'
+
+# Kinds of the steps of a compiled renderer.
+FIELD = 'field'
+GEOMETRY = 'geometry'
+RESULT = 'result'
+NAVIGATION = 'navigation'
+MISSING = object()
+
+
+def model_field(model, name):
+    """
+    Returns the model field of a serializer field name, or None.
+    """
+    try:
+        return model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return None
+
+
+def geojson(geometry):
+    """
+    Returns the GeoJSON object of a GEOS geometry, built from its
+    coordinates instead of parsing its GeoJSON string.
+    """
+    if geometry is None:
+        return None
+    if isinstance(geometry, GeometryCollection) and \
+            not isinstance(geometry, (MultiPoint, MultiLineString, MultiPolygon)):
+        return {
+            'type': 'GeometryCollection',
+            'geometries': [geojson(g) for g in geometry]
+        }
+    return {'type': geometry.geom_type, 'coordinates': geometry.coords}
 
 
 class ControlInformation:
@@ -76,136 +122,212 @@ class ControlInformation:
         ]
     }
 
-    def get_selfLink(self, obj):
-        request = self.context.get('request')
-        model = self.Meta.model.__name__
-        return request.build_absolute_uri(
-                    reverse(ControlInformation.keys[model][0] + '-detail',
-                            kwargs={'pk': obj.id,
-                                    "version": "v1.0"
-                                    }
-                            )
-                    )
-
-    def get_navigationLinks(self, obj):
-        request = self.context.get('request')
-        model = self.Meta.model.__name__
-        nav_links = {}
-        model_kwarg = ControlInformation.keys[model][1]
-        for related_entity in ControlInformation.keys[model][2]:
-            nav_links[list(related_entity.values())[0] + '@iot.navigationLink'] = request.build_absolute_uri(
-                    reverse(list(related_entity.keys())[0] + '-list',
-                            kwargs={model_kwarg: obj.id,
-                                    "version": "v1.0"
-                                    }
-                            )
-                    )
-        return nav_links
+    link_templates = {}
 
-    def to_representation(self, obj):
+    @classmethod
+    def get_link_templates(cls, model):
         """
-        doc string here
-        :param obj:
-        :return:
+        Returns the path templates of the selfLink and the navigationLinks of
+        a model as (prefix, suffix) pairs around the entity id. They are
+        reversed on first use and reused for every entity after that.
         """
-        data = super(ControlInformation, self).to_representation(obj)
-        # have to rename plural fields ...
-
-        model = self.Meta.model.__name__
-        if model == "Thing":
-            try:
-                data['Datastreams'] = data["Datastream"]
-                data.pop('Datastream')
-            except KeyError:
-                pass
-            try:
-                data['Locations'] = data["Location"]
-                data.pop("Location")
-            except KeyError:
-                pass
-            try:
-                data['HistoricalLocations'] = data["HistoricalLocation"]
-                data.pop('HistoricalLocation')
-            except KeyError:
-                pass
-
-        if model == "Datastream":
-            try:
-                data['Observations'] = data["Observation"]
-                data.pop('Observation')
-            except KeyError:
-                pass
-
-        if model == "FeatureOfInterest":
-            try:
-                data['Observations'] = data["Observation"]
-                data.pop('Observation')
-            except KeyError:
-                pass
-
-        if model == "Location":
-            try:
-                data['Things'] = data["Thing"]
-                data.pop('Thing')
-            except KeyError:
-                pass
-            try:
-                data['HistoricalLocations'] = data["HistoricalLocation"]
-                data.pop('HistoricalLocation')
-            except KeyError:
-                pass
-
-        if model == "HistoricalLocation":
-            try:
-                data['Things'] = data["Thing"]
-                data.pop('Thing')
-            except KeyError:
-                pass
-            try:
-                data['Locations'] = data["Location"]
-                data.pop('Location')
-            except KeyError:
-                pass
-
         try:
-            data['@iot.selfLink'] = data['selfLink']
-            data.pop('selfLink')
-            data.move_to_end('@iot.selfLink', last=False)
+            return cls.link_templates[model]
         except KeyError:
             pass
+        basename, model_kwarg, related_entities = cls.keys[model]
+        self_link = reverse(
+            basename + '-detail',
+            kwargs={'pk': LINK_ID, "version": "v1.0"}
+        ).split(LINK_ID)
+        navigation_links = []
+        for related_entity in related_entities:
+            related_basename, name = list(related_entity.items())[0]
+            navigation_links.append((
+                name + '@iot.navigationLink',
+                reverse(
+                    related_basename + '-list',
+                    kwargs={model_kwarg: LINK_ID, "version": "v1.0"}
+                ).split(LINK_ID)
+            ))
+        templates = cls.link_templates[model] = (self_link, navigation_links)
+        return templates
+
+    def get_link_base(self):
+        """
+        Returns the scheme and host of the request, which is shared by all
+        the links of a response.
+        """
         try:
-            data['@iot.id'] = data['id']
-            data.pop('id')
-            data.move_to_end('@iot.id', last=False)
+            return self.context['link_base']
         except KeyError:
-            pass
+            request = self.context.get('request')
+            base = self.context['link_base'] = request.build_absolute_uri('/')[:-1]
+            return base
+
+    def get_selfLink(self, obj):
+        (prefix, suffix), _ = self.get_link_templates(self.Meta.model.__name__)
+        return self.get_link_base() + prefix + str(obj.id) + suffix
+
+    def get_navigationLinks(self, obj):
+        _, navigation_links = self.get_link_templates(self.Meta.model.__name__)
+        base = self.get_link_base()
+        id = str(obj.id)
+        return {
+            key: base + prefix + id + suffix
+            for key, (prefix, suffix) in navigation_links
+        }
+
+    plural_keys = {
+        "Thing": {
+            "Datastream": "Datastreams",
+            "Location": "Locations",
+            "HistoricalLocation": "HistoricalLocations"
+        },
+        "Location": {
+            "Thing": "Things",
+            "HistoricalLocation": "HistoricalLocations"
+        },
+        "HistoricalLocation": {
+            "Thing": "Things",
+            "Location": "Locations"
+        },
+        "Datastream": {
+            "Observation": "Observations"
+        },
+        "FeatureOfInterest": {
+            "Observation": "Observations"
+        }
+    }
+
+    renderers = {}
 
+    @classmethod
+    def compile_renderer(cls, field_names):
+        """
+        Returns the (key, kind, field name) steps that render the given
+        fields of the model in their final order, e.g. id as @iot.id and
+        expanded relations under their plural names. The steps are compiled
+        once per serializer class and set of fields.
+        """
+        key = (cls, field_names)
         try:
-            for navigation_key, navigation_value in data['navigationLinks'].items():
-                data[navigation_key] = navigation_value
-            data.pop('navigationLinks')
+            return cls.renderers[key]
         except KeyError:
             pass
+        model = cls.Meta.model
+        plural_keys = cls.plural_keys.get(model.__name__, {})
+        head = []
+        steps = []
+        navigation = []
+        for name in field_names:
+            if name == 'id':
+                head.insert(0, ('@iot.id', FIELD, name))
+            elif name == 'selfLink':
+                head.append(('@iot.selfLink', FIELD, name))
+            elif name == 'navigationLinks':
+                navigation.append((None, NAVIGATION, name))
+            elif name == 'result' and model is Observation:
+                steps.append((name, RESULT, name))
+            elif isinstance(model_field(model, name), GeometryField):
+                steps.append((name, GEOMETRY, name))
+            else:
+                steps.append((plural_keys.get(name, name), FIELD, name))
+        renderer = cls.renderers[key] = tuple(head + steps + navigation)
+        return renderer
+
+    def get_renderer(self):
+        """
+        Binds the compiled renderer of the serializer to its field instances.
+        """
+        try:
+            return self._renderer
+        except AttributeError:
+            fields = self.fields
+            names = tuple(
+                name for name, field in fields.items() if not field.write_only
+            )
+            self._renderer = [
+                (key, kind, fields[name])
+                for key, kind, name in self.compile_renderer(names)
+            ]
+            return self._renderer
+
+    def project(self, queryset):
+        """
+        Returns the queryset reading only the columns of the fields of the
+        serializer into ValuesRows (see projection.py), or the queryset as is
+        if one of its fields is not read from a column of the model.
+        """
+        model = self.Meta.model
+        columns = ['id']
+        geometries = []
+        for key, kind, field in self.get_renderer():
+            if kind is GEOMETRY:
+                geometries.append(field.source)
+            elif kind is RESULT:
+                columns.append(field.source)
+            elif kind is FIELD and \
+                    not isinstance(field, serializers.SerializerMethodField):
+                column = model_field(model, field.source)
+                if column is None or not column.concrete or column.is_relation:
+                    return queryset
+                if column.name != 'id':
+                    columns.append(column.name)
+        return project_values(queryset, columns, geometries)
 
-        if 'observedArea' in data:
-            if obj.observedArea:
-                data['observedArea'] = json.loads(obj.observedArea.geojson)
-        if 'feature' in data:
-            if obj.feature:
-                data['feature'] = json.loads(obj.feature.geojson)
-        if 'location' in data:
-            if obj.location:
-                data['location'] = json.loads(obj.location.geojson)
-        if 'result' in data:
-            data['result'] = obj.result['result']
+    def to_representation(self, obj):
+        """
+        Renders an entity with its SensorThings control information.
+        Geometries are written as GeoJSON objects straight from GEOS and the
+        result of an Observation is unwrapped from its JSON column.
+        """
+        data = OrderedDict()
+        for key, kind, field in self.get_renderer():
+            if kind is FIELD:
+                try:
+                    attribute = field.get_attribute(obj)
+                except SkipField:
+                    continue
+                data[key] = None if attribute is None \
+                    else field.to_representation(attribute)
+            elif kind is GEOMETRY:
+                # GeoJSON written by the database, see projection.py
+                text = getattr(obj, GEOJSON + field.source, MISSING)
+                if text is MISSING:
+                    data[key] = geojson(getattr(obj, field.source))
+                else:
+                    data[key] = None if text is None else raw_json(text)
+            elif kind is RESULT:
+                data[key] = obj.result['result']
+            else:
+                data.update(self.get_navigationLinks(obj))
         return data
 
 
+class ExpandListSerializer(serializers.ListSerializer):
+    """
+    Lists the entities of an expanded to-many relation. Where Django cannot
+    slice prefetch querysets, the nested $skip and $top of the expansion are
+    applied here to the entities that were not prefetched by a PagedQuerySet,
+    which only fetches the page.
+    """
+    page = None
+
+    def to_representation(self, data):
+        if self.page is not None:
+            iterable = data.all() if isinstance(data, models.Manager) else data
+            if not isinstance(iterable, PagedQuerySet):
+                data = iterable[self.page]
+        return super().to_representation(data)
+
+
 class Expand(ExpanderSerializerMixin):
     """
     Extends and modifies the ExpanderSerializerMixin class to define the
     $expand query option. Use $expand query option to request inline
     information for related entities of the requested entity collection.
+    The related entities are prefetched by Filter.get_queryset.
     """
     def __init__(self, *args, **kwargs):
         expanded_fields = kwargs.pop('expanded_fields', None)
@@ -216,12 +338,8 @@ class Expand(ExpanderSerializerMixin):
         if not get_expandable_fields:
             return
 
-        if not expanded_fields:
-            context = self.context
-            if not context:
-                return
-
-            request = context.get('request', None)
+        if expanded_fields is None:
+            request = self.context.get('request', None)
             if not request:
                 return
 
@@ -233,10 +351,12 @@ class Expand(ExpanderSerializerMixin):
             if not expanded_fields:
                 return
 
-        expansions = dict_from_qs(expanded_fields)
+        if isinstance(expanded_fields, str):
+            expanded_fields = parse_expand(expanded_fields)
 
         base_field = set()
-        for expanded_field, nested_expand in expansions.items():
+        for name, node in expanded_fields.items():
+            expanded_field = MODEL_KEYS.get(name, name)
             base_field.add(expanded_field)
             seen_base = list(base_field)
             expandable_fields = get_expandable_fields(*seen_base)
@@ -252,11 +372,11 @@ class Expand(ExpanderSerializerMixin):
                 kwargs = kwargs.copy()
                 kwargs.setdefault('context', self.context)
 
-                print("context", context)
-
+                if issubclass(serializer_class, Select):
+                    kwargs['select'] = node['options'].get('$select', '')
                 if issubclass(serializer_class, Expand):
                     serializer = serializer_class(
-                        expanded_fields=qs_from_dict(nested_expand),
+                        expanded_fields=node['expand'],
                         *args,
                         **kwargs
                     )
@@ -266,8 +386,9 @@ class Expand(ExpanderSerializerMixin):
                         **kwargs
                     )
 
-                print(serializer)
-                print(serializer.__dict__)
+                if isinstance(serializer, ExpandListSerializer) \
+                        and not PREFETCH_SLICING:
+                    serializer.page = expand_page(node['options'])
 
                 self.fields[expanded_field] = serializer
                 Conflicts.conflicts = []
@@ -276,20 +397,22 @@ class Expand(ExpanderSerializerMixin):
 class Select(serializers.ModelSerializer):
     """
     The $select query option requests specific properties of an entity from
-    the SensorThings service.
+    the SensorThings service. Expanded entities are selected by the $select
+    of their expansion, given as the select argument.
     """
     def __init__(self, *args, **kwargs):
+        select = kwargs.pop('select', None)
         super(Select, self).__init__(*args, **kwargs)
-        select = self.context['request'].query_params.get('$select')
+        if select is None:
+            select = self.context['request'].query_params.get('$select')
 
         if select:
-            select = select.split(',')
-            allowed = set(select)
-            existing = set(self.fields.keys())
-            print("existing", existing)
-            for selected in existing - allowed:
-                # not self.fields --> this does all fields. It shuold be the fields in the unnested serializer
-                self.fields.pop(selected)
+            allowed = set(name.strip() for name in select.split(','))
+            for name, field in list(self.fields.items()):
+                # expanded entities are always included
+                if name not in allowed and \
+                        not isinstance(field, serializers.BaseSerializer):
+                    self.fields.pop(name)
 
 
 class ResultFormat(object):
@@ -6,10 +6,13 @@ doc string here...
 from django.contrib.gis.db import models
 from django.db.models import JSONField
 from django.contrib.postgres.fields import DateTimeRangeField
+from django.contrib.postgres.indexes import BrinIndex, GinIndex, HashIndex
+from django.db.models.fields.json import KeyTransform
 from django.db.models.signals import m2m_changed
 from django.utils import timezone
 from django.dispatch import receiver
 from django.core.exceptions import ValidationError
+from .functions import CustomFunctions
 
 
 ENCODING_TYPES_1 = (
@@ -30,6 +33,50 @@ OBSERVATION_TYPES = (
     ("http://www.opengis.net/def/observationType/OGC-OM/2.0/OM_TruthObservation", "OM Truth Observation (Boolean)")
 )
 
+RESULT_COLUMNS = {
+    "http://www.opengis.net/def/observationType/OGC-OM/2.0/OM_CategoryObservation": "result_text",
+    "http://www.opengis.net/def/observationType/OGC-OM/2.0/OM_CountObservation": "result_number",
+    "http://www.opengis.net/def/observationType/OGC-OM/2.0/OM_Measurement": "result_number",
+    "http://www.opengis.net/def/observationType/OGC-OM/2.0/OM_TruthObservation": "result_bool"
+}
+
+
+def typed_result(value, observation_type):
+    """
+    Returns the typed result columns of an Observation result. The column is
+    chosen from the observationType of the Datastream; OM_Observation results
+    can be of any type, so the column is chosen from the value itself.
+    """
+    columns = {
+        'result_number': None,
+        'result_text': None,
+        'result_bool': None
+    }
+    column = RESULT_COLUMNS.get(observation_type)
+    if column is None:
+        if isinstance(value, bool):
+            column = 'result_bool'
+        elif isinstance(value, (int, float)):
+            column = 'result_number'
+        elif isinstance(value, str):
+            column = 'result_text'
+        else:
+            return columns
+
+    if column == 'result_number':
+        try:
+            columns[column] = float(value)
+        except (TypeError, ValueError):
+            pass
+    elif column == 'result_bool':
+        if isinstance(value, bool):
+            columns[column] = value
+        elif str(value).lower() in ('true', 'false'):
+            columns[column] = str(value).lower() == 'true'
+    elif value is not None:
+        columns[column] = str(value)
+    return columns
+
 
 class Thing(models.Model):
     """
@@ -221,6 +268,25 @@ class Observation(models.Model):
     result = JSONField(  # TODO: change db model
         verbose_name="Result"
     )
+    result_number = models.FloatField(
+        null=True,
+        blank=True,
+        editable=False,
+        db_index=True,
+        verbose_name="Result (Number)"
+    )
+    result_text = models.TextField(
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name="Result (Text)"
+    )
+    result_bool = models.BooleanField(
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name="Result (Boolean)"
+    )
     resultTime = models.DateTimeField(
         verbose_name="Result Time",
         null=True  # although it is a mandatory field, there is a special case that allows for null values.
@@ -256,13 +322,73 @@ class Observation(models.Model):
 
     class Meta:
         verbose_name = "Observation"
+        indexes = [
+            # Observations of a Datastream in time order, the default
+            # ordering of the navigation and $orderby of most requests.
+            models.Index(
+                fields=['Datastream', 'phenomenonTime'],
+                name='observation_datastream_time'
+            ),
+            # Time range filters across Datastreams. Observations are mostly
+            # appended in time order, so a small BRIN index serves them.
+            BrinIndex(
+                fields=['phenomenonTime'],
+                name='observation_time_brin',
+                autosummarize=True
+            ),
+            # Containment lookups on the JSON result.
+            GinIndex(
+                fields=['result'],
+                name='observation_result_gin',
+                opclasses=['jsonb_path_ops']
+            ),
+            # The expressions $filter compares the result with when
+            # TYPED_RESULTS is off: its JSON value, and the rounded numbers
+            # of round(), floor() and ceiling().
+            models.Index(
+                KeyTransform('result', 'result'),
+                name='observation_result_value'
+            ),
+            models.Index(
+                CustomFunctions.Round('result'),
+                name='observation_result_round'
+            ),
+            models.Index(
+                CustomFunctions.Floor('result'),
+                name='observation_result_floor'
+            ),
+            models.Index(
+                CustomFunctions.Ceiling('result'),
+                name='observation_result_ceiling'
+            ),
+            # Equality on the text results when TYPED_RESULTS is on. A hash
+            # index has no size limit on the values, unlike a B-tree.
+            HashIndex(
+                fields=['result_text'],
+                name='observation_result_text'
+            ),
+        ]
 
     def save(self, *args, **kwargs):
+        self.prepare_result()
+        super(Observation, self).save(*args, **kwargs)
+
+    def prepare_result(self):
+        """
+        Wraps the result for the JSON result column and copies it into the
+        typed result column matching the observationType of the Datastream.
+        Observations created with bulk_create have to call this themselves.
+        """
         result = self.result
         if not isinstance(self.result, dict):
             result = {'result': self.result}
         self.result = result
-        super(Observation, self).save(*args, **kwargs)
+        columns = typed_result(
+            self.result.get('result'),
+            self.Datastream.observationType
+        )
+        for column, value in columns.items():
+            setattr(self, column, value)
 
     def __str__(self):
         return '%s' % (self.result['result'])
@@ -1,6 +1,131 @@
+import base64
+import binascii
+import datetime
+import json
+from collections import OrderedDict
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist
+from django.db import connections
+from django.db.models import F, Q
+from django.db.models.expressions import OrderBy
 from rest_framework import pagination
 from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 from .errors import BadRequest
+from .settings import atlas_settings
+
+
+def estimate_count(queryset):
+    """
+    Returns PostgreSQL's estimate of the number of rows of a queryset, or
+    None if there is none. An unfiltered queryset is estimated from the
+    statistics of its table (and its partitions), any other, or one whose
+    table was never analyzed, from the row estimate of its query plan.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    queryset = queryset.order_by()
+    with connection.cursor() as cursor:
+        if not queryset.query.where and not queryset.query.distinct:
+            table = connection.ops.quote_name(queryset.model._meta.db_table)
+            # the parent of a partitioned table and tables that were never
+            # analyzed have reltuples -1 (or 0 before PostgreSQL 14)
+            cursor.execute(
+                "SELECT SUM(reltuples) FROM pg_class WHERE reltuples > 0 "
+                "AND (oid = %s::regclass OR oid IN (SELECT inhrelid "
+                "FROM pg_inherits WHERE inhparent = %s::regclass))",
+                [table, table]
+            )
+            estimate = cursor.fetchone()[0]
+            if estimate:
+                return int(estimate)
+        try:
+            sql, params = queryset.query.sql_with_params()
+        except EmptyResultSet:
+            return 0
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    """
+    Keeps the microseconds of times, which DjangoJSONEncoder truncates, so
+    that a cursor seeks exactly past the last row.
+    """
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super(CursorEncoder, self).default(o)
+
+
+def encode_cursor(values):
+    try:
+        data = json.dumps(values, cls=CursorEncoder)
+    except TypeError:
+        raise BadRequest("The ordering cannot be paginated with a cursor.")
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_cursor(token):
+    try:
+        return json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+    except (ValueError, binascii.Error):
+        raise BadRequest("Invalid $skiptoken.")
+
+
+def ordering_keys(queryset):
+    """
+    Returns the (field, descending) keys of the ordering of a queryset,
+    ending with the primary key so that every row has a unique key.
+    Unordered Observations are ordered by phenomenonTime.
+    """
+    model = queryset.model
+    pk = model._meta.pk.name
+    keys = []
+    for item in queryset.query.order_by or model._meta.ordering:
+        if isinstance(item, str):
+            keys.append((item.lstrip('-'), item.startswith('-')))
+        elif isinstance(item, OrderBy) and isinstance(item.expression, F):
+            keys.append((item.expression.name, item.descending))
+        else:
+            raise BadRequest("The ordering cannot be paginated with a cursor.")
+    keys = [(pk if name == 'pk' else name, descending) for name, descending in keys]
+    if not keys:
+        try:
+            model._meta.get_field('phenomenonTime')
+            keys.append(('phenomenonTime', False))
+        except FieldDoesNotExist:
+            pass
+    if pk not in [name for name, descending in keys]:
+        keys.append((pk, False))
+    return keys
+
+
+def seek_query(keys, values):
+    """
+    Returns the Q object of the rows after the given key values in the
+    ordering of the keys, which sorts nulls first when ascending and last
+    when descending like the Orderby filter.
+    """
+    queries = []
+    equal = Q()
+    for (name, descending), value in zip(keys, values):
+        if value is None:
+            if not descending:
+                queries.append(equal & Q(**{name + '__isnull': False}))
+            equal &= Q(**{name + '__isnull': True})
+        else:
+            if descending:
+                after = Q(**{name + '__lt': value}) | Q(**{name + '__isnull': True})
+            else:
+                after = Q(**{name + '__gt': value})
+            queries.append(equal & after)
+            equal &= Q(**{name: value})
+    return queries
 
 
 class SensorThingsPagination(pagination.LimitOffsetPagination):
@@ -18,7 +143,100 @@ class SensorThingsPagination(pagination.LimitOffsetPagination):
     """
     limit_query_param = '$top'
     offset_query_param = '$skip'
+    cursor_query_param = '$skiptoken'
     max_limit = 100
+    keyset = False
+    estimated = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        """
+        Pages with $skiptoken cursors when KEYSET_PAGINATION is enabled and
+        the request does not ask for $skip, or when it carries a cursor.
+        """
+        self.keyset = self.cursor_query_param in request.query_params or (
+            atlas_settings.KEYSET_PAGINATION and
+            self.offset_query_param not in request.query_params
+        )
+        if self.keyset:
+            return self.paginate_keyset(queryset, request)
+        count = self.wants_count(request)
+        page = self.paginate_offset(queryset, request)
+        if page is not None and count:
+            self.count = self.get_count(queryset)
+        return page
+
+    def paginate_offset(self, queryset, request):
+        """
+        Returns the page at $skip. One more row than the page is fetched to
+        tell whether there is a next page, so that the page does not depend
+        on the count, which may be an estimate.
+        """
+        self.request = request
+        self.count = None
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+        self.offset = self.get_offset(request)
+        page = list(queryset[self.offset:self.offset + self.limit + 1])
+        self.has_next = len(page) > self.limit
+        return page[:self.limit]
+
+    def paginate_keyset(self, queryset, request):
+        """
+        Returns the page after the key of the $skiptoken cursor, fetched
+        with a seek on the ordering instead of an OFFSET.
+        """
+        self.request = request
+        self.cursor = None
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+
+        keys = ordering_keys(queryset)
+        queryset = queryset.order_by(*[
+            F(name).desc(nulls_last=True) if descending
+            else F(name).asc(nulls_first=True)
+            for name, descending in keys
+        ])
+        self.count = None
+        if self.wants_count(request):
+            self.count = self.get_count(queryset)
+
+        token = request.query_params.get(self.cursor_query_param)
+        if token:
+            values = decode_cursor(token)
+            if not isinstance(values, list) or len(values) != len(keys):
+                raise BadRequest("Invalid $skiptoken.")
+            queries = seek_query(keys, values)
+            if not queries:
+                return []
+            query = queries[0]
+            for other in queries[1:]:
+                query |= other
+            queryset = queryset.filter(query)
+
+        page = list(queryset[:self.limit + 1])
+        if len(page) > self.limit:
+            page = page[:self.limit]
+            last = queryset.filter(pk=page[-1].pk)
+            self.cursor = encode_cursor(list(
+                last.values_list(*[name for name, descending in keys])[0]
+            ))
+        return page
+
+    def get_next_link(self):
+        if not self.keyset:
+            if not self.has_next:
+                return None
+            url = self.request.build_absolute_uri()
+            url = replace_query_param(url, self.limit_query_param, self.limit)
+            return replace_query_param(
+                url, self.offset_query_param, self.offset + self.limit)
+        if self.cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.offset_query_param)
+        return replace_query_param(url, self.cursor_query_param, self.cursor)
 
     def get_limit(self, request):
         if self.limit_query_param:
@@ -45,30 +263,45 @@ class SensorThingsPagination(pagination.LimitOffsetPagination):
         except ValueError:
             raise BadRequest()
 
-    def get_paginated_response(self, data):
-        count = self.request.query_params.get('$count')
+    def wants_count(self, request):
+        count = request.query_params.get('$count')
+        if count is None:
+            return atlas_settings.COUNT_BY_DEFAULT
+        if count == 'true':
+            return True
         if count == 'false':
-            if self.get_next_link():
-                return Response({
-                    'value': data,
-                    '@iot.nextLink': self.get_next_link()
-                    })
-            else:
-                return Response({
-                    'value': data
-                    })
-        elif count == 'true' or not count:
-            if self.get_next_link():
-                return Response({
-                    '@iot.count': self.count,
-                    'value': data,
-                    '@iot.nextLink': self.get_next_link()
-                    })
-            else:
-                return Response({
-                    '@iot.count': self.count,
-                    'value': data
-                    })
-        else:
-            raise BadRequest()
+            return False
+        raise BadRequest()
+
+    def get_count(self, queryset):
+        """
+        Returns the planner's estimate instead of an exact count for results
+        of at least COUNT_ESTIMATE_THRESHOLD rows. The count is only reported
+        as @iot.count; the pages are found without it.
+        """
+        self.estimated = False
+        threshold = atlas_settings.COUNT_ESTIMATE_THRESHOLD
+        if threshold is not None:
+            estimate = estimate_count(queryset)
+            if estimate is not None and estimate >= threshold:
+                self.estimated = True
+                return estimate
+        return super(SensorThingsPagination, self).get_count(queryset)
+
+    def get_paginated_response(self, data):
+        return Response(self.get_paginated_envelope(data))
 
+    def get_paginated_envelope(self, data):
+        """
+        Returns the members of a page response in their order.
+        """
+        response = OrderedDict()
+        if self.count is not None:
+            response['@iot.count'] = self.count
+            if atlas_settings.COUNT_ESTIMATE_THRESHOLD is not None:
+                response['@sensorAtlas.countEstimated'] = self.estimated
+        response['value'] = data
+        next_link = self.get_next_link()
+        if next_link:
+            response['@iot.nextLink'] = next_link
+        return response
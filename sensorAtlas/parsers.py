@@ -1,159 +1,228 @@
 from __future__ import unicode_literals
 
+import functools
+import operator
 import re
-import boolean
+import threading
+import dateutil.parser
 
+from collections import OrderedDict, namedtuple
 from urllib.parse import unquote
 from rest_framework import filters
-from django.db.models import Q, F
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connections
+from django.db.models import Q, F, Prefetch, QuerySet, Window, DateTimeField
+from django.db.models.fields.related import ForeignObjectRel
+from django.db.models.functions import RowNumber
 from rest_framework.exceptions import ParseError
 from .errors import NotImplemented501, BadRequest, Unprocessable
 from django.utils import timezone
-from datetime import datetime
-from .functions import QueryFunctions, QueryOperations
+from datetime import datetime, time, timedelta
+from .functions import QueryFunctions, QueryOperations, result_field, \
+    numeric_result
+from .settings import atlas_settings
+from .projection import annotate_geojson
+from .utils import PREFETCH_SLICING, expand_page, parse_expand
 from .viewsets import MODEL_KEYS
 from .models import Datastream
 
 
-def lexer(string):  # TODO: refactor
+# Tokens of a filter expression, matched in a single pass. Single or double
+# quoted strings, numbers, dates and times are literals.
+TOKEN = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<string>(?:geography|geometry)?(?:'(?:[^']|'')*'|"(?:[^"]|"")*"))
+  | (?P<datetime>\d{4}-\d{2}-\d{2}
+        (?:T\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?)?)
+  | (?P<time>\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?)
+  | (?P<number>-?\d+(?:\.\d*)?(?:[eE][+-]?\d+)?(?![\w.]))
+  | (?P<name>[A-Za-z_$][\w.]*(?:/[A-Za-z_$][\w.]*)*)
+  | (?P<lparen>\()
+  | (?P<rparen>\))
+  | (?P<comma>,)
+""", re.VERBOSE)
+LITERALS = ('string', 'datetime', 'time', 'number')
+FUNCTION = re.compile(r'^([\w.]+)\((.*)\)$', re.DOTALL)
+
+# Binding powers of the binary operators. Comparisons bind tighter than the
+# boolean operators and looser than arithmetic, as in OData.
+PRECEDENCE = {
+    'or': 1,
+    'and': 2,
+    'eq': 3,
+    'ne': 3,
+    'gt': 3,
+    'ge': 3,
+    'lt': 3,
+    'le': 3,
+    'add': 4,
+    'sub': 4,
+    'mul': 5,
+    'div': 5,
+    'mod': 5
+}
+COMPARISON = 3
+
+Literal = namedtuple('Literal', ['slot'])
+Name = namedtuple('Name', ['path'])
+Call = namedtuple('Call', ['name', 'args'])
+Not = namedtuple('Not', ['operand'])
+Operation = namedtuple('Operation', ['operator', 'lhs', 'rhs'])
+
+
+def tokenize(string):
     """
-    Takes the url decoded querystring and returns a
+    Splits a filter expression into tokens in a single pass. Literals are
+    replaced by ('literal', slot) tokens and returned separately, so that
+    expressions that only differ in their values have the same tokens.
     """
-    parsedlist = []
-    parsedstring = ''
-    leftbcounter = 0
-    rightbcounter = 0
-    qcounter = 0
-    for index, a in enumerate(string):
-        if qcounter == 2:
-            if a.isalpha():
-                qcounter = 1
-            else:
-                qcounter = 0
-        if a == '(':
-            leftbcounter += 1
-        if a == ')':
-            rightbcounter += 1
-        if a == "'" and leftbcounter == rightbcounter:
-            qcounter += 1
-        if a != ' ' and leftbcounter == rightbcounter \
-                and qcounter == 0:
-            parsedstring += a
-            if index+1 == len(string):
-                parsedlist.append(parsedstring)
-                parsedstring = ''
-        elif leftbcounter != rightbcounter:
-            parsedstring += a
-        elif qcounter > 0:
-            parsedstring += a
-            if index+1 == len(string):
-                parsedlist.append(parsedstring)
-                parsedstring = ''
-        else:
-            parsedlist.append(parsedstring)
-            parsedstring = ''
-    if leftbcounter != rightbcounter:
-        raise BadRequest()
-    bl = []
-    sl = []
-    counter = 0
-    for index, query in enumerate(parsedlist, 1):
-        if query == "and" or query == "or" or query == "not":
-            if sl:
-                bl.append(sl)
-            bl.append([query])
-            counter = 0
-            sl = []
-            continue
-        sl.append(query)
-        counter += 1
-        if index == len(parsedlist) and sl:
-            bl.append(sl)
-    # i later added a third nested list to seperate AND and OR
-    query_list = []
-    al = []
-    counter = 0
-    for index, grouped_query in enumerate(bl, 1):
-        if grouped_query[0] == "or":
-            query_list.append(al)
-            query_list.append([grouped_query])
-            counter = 0
-            al = []
-            continue
-        al.append(grouped_query)
-        counter += 1
-        if index == len(bl):
-            query_list.append(al)
-
-    for x in query_list:
-        for y in x:
-            if y[0] == 'and' or y[0] == 'or' or y[0] == 'not':
-                QueryObjects.B.append(y[0])
-                continue
-            if y[0][0] == '(' and y[0][-1] == ')':
-                QueryObjects.B.append(y[0][0])
-                lexer(y[0][1:-1])
-                QueryObjects.B.append(y[0][-1])
-            else:
-                QueryObjects.IND += 1
-                n = 'arg' + str(QueryObjects.IND)
-                QueryObjects.D[n] = query_mapping(y, QueryObjects.IND)["query"]
-                QueryObjects.B.append(n)
-    return QueryObjects.B
+    tokens = []
+    literals = []
+    position = 0
+    while position < len(string):
+        match = TOKEN.match(string, position)
+        if match is None:
+            raise BadRequest("Unexpected character at position %d" % position)
+        kind = match.lastgroup
+        if kind in LITERALS:
+            tokens.append(('literal', len(literals)))
+            literals.append(match.group())
+        elif kind != 'space':
+            tokens.append((kind, match.group()))
+        position = match.end()
+    return tuple(tokens), literals
+
+
+class FilterParser:
+    """
+    A precedence climbing parser that turns the tokens of a filter
+    expression into a tree of Literal, Name, Call, Not and Operation nodes.
+    """
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise BadRequest("Unexpected end of $filter")
+        self.position += 1
+        return token
+
+    def expect(self, kind):
+        token = self.next()
+        if token[0] != kind:
+            raise BadRequest("Expected %s in $filter" % kind)
+        return token
+
+    def parse(self):
+        tree = self.expression()
+        if self.position != len(self.tokens):
+            raise BadRequest("Unexpected %s in $filter" % self.peek()[1])
+        return tree
+
+    def expression(self, min_precedence=1):
+        lhs = self.operand()
+        while True:
+            kind, value = self.peek()
+            if kind != 'name' or PRECEDENCE.get(value, 0) < min_precedence:
+                return lhs
+            self.next()
+            rhs = self.expression(PRECEDENCE[value] + 1)
+            lhs = Operation(value, lhs, rhs)
+
+    def operand(self):
+        kind, value = self.next()
+        if kind == 'literal':
+            return Literal(value)
+        if kind == 'lparen':
+            tree = self.expression()
+            self.expect('rparen')
+            return tree
+        if kind == 'name':
+            if value == 'not':
+                # not applies to a whole comparison, e.g. not result eq 1
+                return Not(self.expression(COMPARISON))
+            if self.peek()[0] != 'lparen':
+                return Name(value)
+            self.next()
+            args = []
+            if self.peek()[0] != 'rparen':
+                args.append(self.expression())
+                while self.peek()[0] == 'comma':
+                    self.next()
+                    args.append(self.expression())
+            self.expect('rparen')
+            return Call(value, tuple(args))
+        raise BadRequest("Unexpected %s in $filter" % value)
 
 
 def function_lexer(string):
-    """A brute force lexer for funcions of the SensorThings API.
-    Returns a list of the function and parameters"""
-    parsedlist = []
-    parsedstring = ''
-    leftbcounter = 0
-    rightbcounter = 0
-    for i, a in enumerate(string):
-        if a == '(':
-            leftbcounter += 1
-        if a == ')':
-            rightbcounter += 1
-        if a == '(' and leftbcounter != 1:
-            parsedstring += a
-        elif a == '(' and leftbcounter == 1:
-            parsedlist.append(parsedstring)
-            parsedstring = ''
-        elif a == ')' and i+1 == len(string):
-            parsedlist.append(parsedstring)
-        else:
-            parsedstring += a
-    return parsedlist
-
-
-def solve_arithmetic(expression):
-    # TODO: allow multiple arithmetic operations
-    indices = [i for i, x in enumerate(expression) if x in QueryOperations.arithmetic_operators]
-
-    if len(indices) > 1:
-        raise NotImplemented501()
-
-    new_expression = expression
-    for ind in indices:
-        lhs = new_expression[ind - 1]
-        rhs = new_expression[ind + 1]
-        value = new_expression[ind] + "(" + lhs + "," + rhs + ")"
-        new_expression[ind-1:ind+2] = str(value),
-
-    return new_expression
+    """
+    Returns a list of the function and its parameter string, or an empty
+    list if the string is not a function call.
+    """
+    match = FUNCTION.match(string)
+    if match:
+        return [match.group(1), match.group(2)]
+    return []
 
 
-def query_mapping(y, index):
+def date_range_query(field, comparison, value):
+    """
+    Rewrites a comparison on date(field) of a DateTimeField into a range on
+    the field itself.
+    Unlike a comparison on the ::date cast, a range can use an index on the
+    field and lets PostgreSQL prune the partitions of a partitioned
+    Observation table. Returns None if the value is not a date.
+    """
+    try:
+        day = dateutil.parser.parse(value).date()
+    except (ValueError, OverflowError, TypeError):
+        return None
+    start = timezone.make_aware(datetime.combine(day, time.min))
+    end = timezone.make_aware(datetime.combine(day + timedelta(days=1), time.min))
+    ranges = {
+        'eq': Q(**{field + '__gte': start, field + '__lt': end}),
+        'ne': Q(**{field + '__lt': start}) | Q(**{field + '__gte': end}),
+        'gt': Q(**{field + '__gte': end}),
+        'ge': Q(**{field + '__gte': start}),
+        'lt': Q(**{field + '__lt': start}),
+        'le': Q(**{field + '__lt': end})
+    }
+    return ranges[comparison]
+
+
+def is_datetime_field(model, path):
+    """
+    Returns whether a property path of a filter, e.g. phenomenonTime or
+    Datastream/phenomenonTime, is a DateTimeField of the model.
+    """
+    if model is None:
+        return False
+    names = [MODEL_KEYS.get(name, name) for name in path.split('/')]
+    try:
+        for name in names[:-1]:
+            model = model._meta.get_field(name).related_model
+            if model is None:
+                return False
+        field = model._meta.get_field(names[-1])
+    except FieldDoesNotExist:
+        return False
+    return isinstance(field, DateTimeField)
+
+
+def query_mapping(y, index, model=None):
     """
     Maps Sensor Things filter expressions with their django or raw
     PostgreSQL counterparts.
     """
     d = {}
-    if any([i in QueryOperations.arithmetic_operators
-            for i in y]):
-
-        y = solve_arithmetic(y)
-
     if len(y) == 1:
         parse_function = function_lexer(y[0])
 
@@ -172,9 +241,14 @@ def query_mapping(y, index):
         operandA = '__'.join(operandA)
         operator = QueryOperations.comparison_operators[y[1]]
         operandB = y[2]
+        date_field = None
 
         if function_lexer(operandA):
             parse_function = function_lexer(operandA)
+            if parse_function[0] == 'date' and \
+                    is_datetime_field(model, parse_function[1]):
+                date_field = '__'.join(
+                    MODEL_KEYS.get(name, name) for name in parse_function[1].split('/'))
             if parse_function[0] in QueryOperations.arithmetic_operators:
                 func = QueryOperations.arithmetic_operators[parse_function[0]]
             else:
@@ -188,11 +262,9 @@ def query_mapping(y, index):
 
             funcres = func(parse_function[1], index=index, numbers=False)
 
-            try:
-                operandA = funcres['query_field']
-                QueryObjects.TEMP_FIELD = funcres['annotation']
-            except KeyError:
-                pass
+            operandA = funcres.get('query_field', operandA)
+            if 'annotation' in funcres:
+                d['annotation'] = funcres['annotation']
         if operandB[0] == "'" or operandB[0] == '"':
             operandB = operandB[1:-1]
 
@@ -236,13 +308,29 @@ def query_mapping(y, index):
             # return func(parse_function[1], index=index)
                 raise NotImplemented501()
 
+        if date_field:
+            query = date_range_query(date_field, y[1], operandB)
+            if query is not None:
+                d['query'] = query
+                return d
 
         try:
             operandB = float(operandB)
         except ValueError:
             pass
         if operandA == 'result':
-            operandA = 'result__result'
+            if isinstance(operandB, float):
+                operandA = result_field('number')
+            elif atlas_settings.TYPED_RESULTS and y[2] in ('true', 'false'):
+                operandA = result_field('bool')
+                operandB = y[2] == 'true'
+            else:
+                operandA = result_field('text')
+            if atlas_settings.TYPED_RESULTS and y[1] == 'ne':
+                # results stored in another typed column are never equal
+                d['query'] = Q(**{operandA + operator: operandB}) | \
+                    Q(**{operandA + '__isnull': True})
+                return d
         if operandB == 'result':
             operandB = 'result__result'
         d['query'] = Q(**{operandA + operator: operandB})
@@ -251,37 +339,272 @@ def query_mapping(y, index):
         raise ParseError()
 
 
-def parser(string, queryset):
+def is_arithmetic(node):
+    return isinstance(node, Operation) and \
+        node.operator in QueryOperations.arithmetic_operators
+
+
+class FilterPlan:
     """
-    Parses the lexicated list and applies the appropriate django
-    filters. Returns a queryset.
+    A parsed $filter expression whose literals are slots. Binding the
+    literals of a request builds its Q object, so time functions such as
+    now() are evaluated on every request.
     """
-    QueryObjects.D = {}
-    QueryObjects.B = []
-    QueryObjects.IND = 0
-    QueryObjects.TEMP_FIELD = None
+    def __init__(self, tree, model=None):
+        self.tree = tree
+        self.model = model
+
+    def bind(self, literals):
+        """
+        Returns the Q object and the annotations of the filter with the given
+        literals.
+        """
+        binding = FilterBinding(literals, self.model)
+        return binding.query(self.tree), binding.annotations
+
 
-    algebra = boolean.BooleanAlgebra()
-    query_list = lexer(string)
-    query_string = ' '.join(query_list)
-    qs = algebra.parse(query_string)
+class FilterBinding:
+    """
+    Builds the Q object of a FilterPlan for one set of literals. Comparisons
+    and function calls are numbered in the order they appear, which names
+    the annotations they need.
+    """
+    def __init__(self, literals, model=None):
+        self.literals = literals
+        self.model = model
+        self.annotations = {}
+        self.index = 0
+
+    def query(self, node):
+        if isinstance(node, Not):
+            return ~self.query(node.operand)
+        if isinstance(node, Call):
+            return self.mapping([self.text(node)])
+        if isinstance(node, Operation):
+            if node.operator in BOOLEAN:
+                # long chains of or / and are combined without recursing
+                # once per operand
+                operands = []
+                stack = [node]
+                while stack:
+                    operand = stack.pop()
+                    if isinstance(operand, Operation) and \
+                            operand.operator == node.operator:
+                        stack.extend((operand.rhs, operand.lhs))
+                    else:
+                        operands.append(operand)
+                return functools.reduce(
+                    BOOLEAN[node.operator],
+                    [self.query(operand) for operand in operands]
+                )
+            if node.operator in QueryOperations.comparison_operators:
+                return self.comparison(node)
+        raise BadRequest("Not a boolean expression")
+
+    def mapping(self, y):
+        self.index += 1
+        d = query_mapping(y, self.index, self.model)
+        self.annotations.update(d.get('annotation', {}))
+        return d['query']
+
+    def comparison(self, node):
+        lhs = self.fold(node.lhs)
+        rhs = self.fold(node.rhs)
+        if not is_arithmetic(lhs) and not is_arithmetic(rhs):
+            query = self.within_distance(lhs, node.operator, rhs)
+            if query is not None:
+                return query
+            return self.mapping([self.text(lhs), node.operator, self.text(rhs)])
+
+        comparison = node.operator
+        if not is_arithmetic(lhs):
+            lhs, rhs = rhs, lhs
+            comparison = MIRRORED.get(comparison, comparison)
+        self.index += 1
+        temporary_field = 'temp' + str(self.index)
+        self.annotations[temporary_field] = self.expression(lhs)
+        lookup = QueryOperations.comparison_operators[comparison]
+        return Q(**{temporary_field + lookup: self.expression(rhs)})
+
+    def within_distance(self, lhs, comparison, rhs):
+        """
+        Returns the query of geo.distance(x, geometry) lt / le a number as
+        ST_DWithin, so that it can use the spatial index of x instead of
+        computing the distance of every row, or None for other comparisons.
+        """
+        if isinstance(rhs, Call) and rhs.name == 'geo.distance':
+            lhs, rhs = rhs, lhs
+            comparison = MIRRORED.get(comparison, comparison)
+        if not isinstance(lhs, Call) or lhs.name != 'geo.distance' or \
+                not isinstance(rhs, Literal) or comparison not in ('lt', 'le'):
+            return None
+        try:
+            distance = float(self.literals[rhs.slot])
+        except ValueError:
+            return None
+        self.index += 1
+        d = QueryFunctions.geo_within_distance(
+            ','.join(self.text(arg) for arg in lhs.args),
+            comparison,
+            distance,
+            index=self.index
+        )
+        self.annotations.update(d.get('annotation', {}))
+        return d['query']
+
+    def fold(self, node):
+        """
+        Evaluates arithmetic on numbers only, so that it is compared as a
+        number.
+        """
+        if not is_arithmetic(node):
+            return node
+        lhs = self.fold(node.lhs)
+        rhs = self.fold(node.rhs)
+        if not isinstance(lhs, Literal) or not isinstance(rhs, Literal):
+            return Operation(node.operator, lhs, rhs)
+        try:
+            value = ARITHMETIC[node.operator](
+                float(self.literals[lhs.slot]), float(self.literals[rhs.slot]))
+        except (ValueError, ZeroDivisionError):
+            return Operation(node.operator, lhs, rhs)
+        self.literals = self.literals + [repr(value)]
+        return Literal(len(self.literals) - 1)
+
+    def text(self, node):
+        """
+        Returns the filter text of an operand, as the query functions expect
+        it.
+        """
+        if isinstance(node, Literal):
+            return self.literals[node.slot]
+        if isinstance(node, Name):
+            return node.path
+        if isinstance(node, Call):
+            return '%s(%s)' % (node.name, ','.join(self.text(arg) for arg in node.args))
+        raise NotImplemented501()
+
+    def expression(self, node):
+        """
+        Returns the ORM expression of an arithmetic operand.
+        """
+        if isinstance(node, Literal):
+            try:
+                return float(self.literals[node.slot])
+            except ValueError:
+                raise BadRequest("Arithmetic on a string")
+        if isinstance(node, Name):
+            if node.path == 'result':
+                return numeric_result('result')
+            return F('__'.join(MODEL_KEYS.get(x, x) for x in node.path.split('/')))
+        if is_arithmetic(node):
+            return ARITHMETIC[node.operator](
+                self.expression(node.lhs), self.expression(node.rhs))
+        if isinstance(node, Call) and node.name in QueryFunctions.implemented:
+            self.index += 1
+            d = QueryFunctions.implemented[node.name](
+                ','.join(self.text(arg) for arg in node.args), index=self.index)
+            if 'annotation' in d:
+                return list(d['annotation'].values())[0]
+            if 'query_field' in d:
+                return F(d['query_field'])
+        raise NotImplemented501()
 
-    if QueryObjects.TEMP_FIELD:
-        queryset = queryset.annotate(**QueryObjects.TEMP_FIELD)
-        QueryObjects.TEMP_FIELD = None
 
-    locals().update(QueryObjects.D.items())
-    query = str(qs)
-    query = eval(query)
-    queryset = queryset.filter(query)
-    return queryset
+BOOLEAN = {
+    'and': operator.and_,
+    'or': operator.or_
+}
+ARITHMETIC = {
+    'add': operator.add,
+    'sub': operator.sub,
+    'mul': operator.mul,
+    'div': operator.truediv,
+    'mod': operator.mod
+}
+MIRRORED = {
+    'gt': 'lt',
+    'ge': 'le',
+    'lt': 'gt',
+    'le': 'ge'
+}
+
+
+class PlanCache:
+    """
+    A thread-safe LRU cache of FilterPlans keyed by the tokens of the filter
+    and the model it filters. cache_info() reports its hits and misses, like
+    functools.lru_cache.
+    """
+    def __init__(self, maxsize=None):
+        self._maxsize = maxsize
+        self.plans = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def maxsize(self):
+        if self._maxsize is None:
+            return atlas_settings.FILTER_CACHE_SIZE
+        return self._maxsize
+
+    def get(self, tokens, model):
+        key = (tokens, model._meta.label)
+        with self.lock:
+            plan = self.plans.get(key)
+            if plan is not None:
+                self.plans.move_to_end(key)
+                self.hits += 1
+                return plan
+            self.misses += 1
+
+        plan = FilterPlan(FilterParser(tokens).parse(), model)
+        with self.lock:
+            self.plans[key] = plan
+            while len(self.plans) > self.maxsize:
+                self.plans.popitem(last=False)
+        return plan
+
+    def cache_info(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'maxsize': self.maxsize,
+                'currsize': len(self.plans)
+            }
+
+    def clear(self):
+        with self.lock:
+            self.plans.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+plan_cache = PlanCache()
+
+
+def compile_filter(string, model):
+    """
+    Returns the Q object and the annotations of a filter expression on the
+    given model, reusing the cached plan of its tokens.
+    """
+    tokens, literals = tokenize(string)
+    if not plan_cache.maxsize:
+        return FilterPlan(FilterParser(tokens).parse(), model).bind(literals)
+    return plan_cache.get(tokens, model).bind(literals)
 
 
-class QueryObjects:
-    D = {}
-    B = []
-    IND = 0
-    TEMP_FIELD = None
+def parser(string, queryset):
+    """
+    Compiles the filter expression and applies it to the queryset. Returns a
+    queryset.
+    """
+    query, annotations = compile_filter(string, queryset.model)
+    if annotations:
+        queryset = queryset.annotate(**annotations)
+    return queryset.filter(query)
 
 
 class Orderby(filters.OrderingFilter):
@@ -332,6 +655,193 @@ class Orderby(filters.OrderingFilter):
         return queryset
 
 
+EXPAND_OPTIONS = {'$filter', '$orderby', '$select', '$skip', '$top'}
+
+
+def orderby_expressions(string, model):
+    """
+    Returns the ordering expressions of an $orderby option of an expanded
+    relation, ordered like the Orderby filter.
+    """
+    expressions = []
+    for item in string.split(','):
+        parts = item.split()
+        if not parts or len(parts) > 2 or parts[1:] not in ([], ['asc'], ['desc']):
+            raise BadRequest()
+        path = [MODEL_KEYS.get(name, name) for name in parts[0].split('/')]
+        try:
+            model._meta.get_field(path[0])
+        except FieldDoesNotExist:
+            raise BadRequest()
+        field = F('__'.join(path))
+        if parts[1:] == ['desc']:
+            expressions.append(field.desc(nulls_last=True))
+        else:
+            expressions.append(field.asc(nulls_first=True))
+    return expressions
+
+
+def select_columns(select, model, required=()):
+    """
+    Returns the columns of the model to load for a $select: the id, the
+    selected properties that are columns and the required fields, e.g. the
+    foreign keys the expanded relations are joined on.
+    """
+    columns = ['id']
+    for name in list(select.split(',')) + list(required):
+        try:
+            field = model._meta.get_field(name.strip())
+        except FieldDoesNotExist:
+            continue
+        if field.concrete and field.name not in columns and \
+                (not field.is_relation or field.many_to_one):
+            columns.append(field.name)
+    return columns
+
+
+def expand_columns(tree, model):
+    """
+    Returns the foreign keys of the model that the relations of an $expand
+    tree are prefetched through.
+    """
+    columns = []
+    for name in tree:
+        try:
+            field = model._meta.get_field(MODEL_KEYS.get(name, name))
+        except FieldDoesNotExist:
+            continue
+        if field.many_to_one:
+            columns.append(field.name)
+    return columns
+
+
+class PagedQuerySet(QuerySet):
+    """
+    Prefetch queryset of an expanded to-many relation whose nested $skip and
+    $top are applied in SQL where Django cannot slice prefetch querysets.
+    Once the prefetch filtered it on the entities it is related to, only the
+    rows numbered within the page, in the ordering of the entity they are
+    related to, are fetched.
+    """
+    partition = None
+    page = None
+
+    def paged(self, partition, page):
+        clone = self._chain()
+        clone.partition = partition
+        clone.page = page
+        return clone
+
+    def _clone(self):
+        clone = super(PagedQuerySet, self)._clone()
+        clone.partition = self.partition
+        clone.page = self.page
+        return clone
+
+    def _fetch_all(self):
+        if self._result_cache is None and self.page is not None:
+            self.query = self.page_query()
+            self.page = None
+        super(PagedQuerySet, self)._fetch_all()
+
+    def page_query(self):
+        """
+        Returns the query restricted to the (pk, partition) pairs whose
+        ROW_NUMBER() over their partition is in the page.
+        """
+        ranked = self.annotate(
+            _partition=F(self.partition),
+            _row=Window(
+                RowNumber(),
+                partition_by=F(self.partition),
+                order_by=list(self.query.order_by) or ['pk']
+            )
+        ).order_by().values_list('pk', '_partition', '_row')
+        sql, params = ranked.query.sql_with_params()
+
+        query = self.query.chain()
+        compiler = query.get_compiler(self.db)
+        pk_sql, pk_params = compiler.compile(F('pk').resolve_expression(query))
+        partition_sql, partition_params = compiler.compile(
+            F(self.partition).resolve_expression(query))
+        pk = connections[self.db].ops.quote_name(self.model._meta.pk.column)
+        subquery = 'SELECT ranked.{}, ranked."_partition" FROM ({}) ranked ' \
+            'WHERE ranked."_row" > %s'.format(pk, sql)
+        bounds = [self.page.start]
+        if self.page.stop is not None:
+            subquery += ' AND ranked."_row" <= %s'
+            bounds.append(self.page.stop)
+        query.add_extra(
+            None, None,
+            ['({}, {}) IN ({})'.format(pk_sql, partition_sql, subquery)],
+            list(pk_params) + list(partition_params) + list(params) + bounds,
+            None, None
+        )
+        return query
+
+
+def expand_prefetches(tree, model, prefix=''):
+    """
+    Returns the Prefetch lookups of an $expand tree (see utils.parse_expand),
+    so each expanded relation is loaded with one query whatever the number
+    of entities in the page. The nested $select, $filter, $orderby, $skip
+    and $top of a relation become its prefetch queryset; where Django cannot
+    slice prefetch querysets, $skip and $top go through a PagedQuerySet.
+    """
+    prefetches = []
+    for name, node in tree.items():
+        relation = MODEL_KEYS.get(name, name)
+        try:
+            field = model._meta.get_field(relation)
+        except FieldDoesNotExist:
+            continue
+        related_model = field.related_model
+        options = node['options']
+        if not set(options).issubset(EXPAND_OPTIONS):
+            raise NotImplemented501()
+
+        page = expand_page(options)
+        paged = page is not None and not PREFETCH_SLICING and \
+            (field.one_to_many or field.many_to_many)
+        if paged:
+            queryset = PagedQuerySet(related_model)
+        else:
+            queryset = related_model.objects.all()
+        if options.get('$select'):
+            required = expand_columns(node['expand'], related_model)
+            if field.one_to_many:
+                # the foreign key the prefetched entities are matched on
+                required.append(field.field.name)
+            queryset = queryset.only(
+                *select_columns(options['$select'], related_model, required)
+            )
+        queryset = annotate_geojson(queryset)
+        if options.get('$filter'):
+            queryset = parser(options['$filter'], queryset)
+        if options.get('$orderby'):
+            queryset = queryset.order_by(
+                *orderby_expressions(options['$orderby'], related_model)
+            )
+        elif page is not None:
+            queryset = queryset.order_by('pk')
+        if page is not None and PREFETCH_SLICING:
+            queryset = queryset[page]
+        elif paged:
+            # the entities are numbered per entity of the other side
+            if isinstance(field, ForeignObjectRel):
+                partition = field.field.name
+            else:
+                partition = field.related_query_name()
+            queryset = queryset.paged(partition, page)
+
+        lookup = prefix + relation
+        prefetches.append(Prefetch(lookup, queryset=queryset))
+        prefetches.extend(
+            expand_prefetches(node['expand'], related_model, lookup + '__')
+        )
+    return prefetches
+
+
 class Filter:
     """$filter
     Use $filter query option to perform conditional operations on the
@@ -357,10 +867,22 @@ class Filter:
             except Exception as e:
                 raise BadRequest("Malformed request: " + str(e))
 
-        elif queryexpand:
-            # Datastream.objects.filter(id=1)
-            print(qs)
-        return qs
+        queryselect = querydict.get('$select', None)
+        if queryexpand:
+            try:
+                tree = parse_expand(queryexpand)
+                qs = qs.prefetch_related(*expand_prefetches(tree, qs.model))
+                if queryselect:
+                    qs = qs.only(*select_columns(
+                        queryselect, qs.model, expand_columns(tree, qs.model)
+                    ))
+            except (NotImplemented501, BadRequest, Unprocessable):
+                raise
+            except Exception as e:
+                raise BadRequest("Malformed request: " + str(e))
+        elif queryselect:
+            qs = qs.only(*select_columns(queryselect, qs.model))
+        return annotate_geojson(qs)
 
 
 class CustomParser:
@@ -0,0 +1,131 @@
+"""
+Column projections of list requests.
+
+A request that narrows the entities with $select and expands nothing is
+read with values(): only the selected columns are fetched, geometries as
+GeoJSON text written by ST_AsGeoJSON, and every row becomes a ValuesRow
+instead of a model instance. A ValuesRow reads like the instance it stands
+in for, so the serializers render it unchanged.
+
+With GEOJSON_IN_DATABASE, or when the geometries of a model are simplified
+or rounded, other querysets load the GeoJSON of their geometries the same
+way, in annotations next to the model's columns.
+"""
+from django.contrib.gis.db.models import GeometryField
+from django.contrib.gis.db.models.functions import AsGeoJSON, \
+    GeomOutputGeoFunc
+from django.db.models import Value
+from django.db.models.query import BaseIterable
+from .settings import atlas_settings
+
+
+# Prefix of the annotations that hold the GeoJSON of a geometry column.
+GEOJSON = 'geojson_'
+
+
+class ValuesRow(dict):
+    """
+    A values() row whose columns can also be read as attributes, like on the
+    model instance, e.g. by DRF's ModelField. The GeoJSON annotation of a
+    geometry is read under the name of its column.
+    """
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            pass
+        if name == 'pk':
+            return self['id']
+        try:
+            return self[GEOJSON + name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class ValuesRowIterable(BaseIterable):
+    """
+    Iterable of a values() queryset that yields a ValuesRow for each row.
+    """
+    def __iter__(self):
+        queryset = self.queryset
+        query = queryset.query
+        compiler = query.get_compiler(queryset.db)
+        names = [
+            *query.extra_select,
+            *query.values_select,
+            *query.annotation_select,
+        ]
+        for row in compiler.results_iter(chunked_fetch=self.chunked_fetch,
+                                         chunk_size=self.chunk_size):
+            yield ValuesRow(zip(names, row))
+
+
+class SimplifyPreserveTopology(GeomOutputGeoFunc):
+    function = 'ST_SimplifyPreserveTopology'
+
+
+def geojson_expression(model, name):
+    """
+    Returns the ST_AsGeoJSON expression of a geometry column, simplified and
+    rounded as configured for its model in GEOMETRY_SIMPLIFY and
+    GEOMETRY_PRECISION.
+    """
+    entity = model.__name__
+    expression = name
+    tolerance = atlas_settings.GEOMETRY_SIMPLIFY.get(entity)
+    if tolerance:
+        expression = SimplifyPreserveTopology(name, Value(tolerance))
+    precision = atlas_settings.GEOMETRY_PRECISION.get(
+        entity, atlas_settings.GEOJSON_PRECISION)
+    return AsGeoJSON(expression, precision=precision)
+
+
+def reads_geojson(model):
+    """
+    Whether the geometries of the model are read as GeoJSON written by the
+    database, which is always the case when they are simplified or rounded.
+    """
+    entity = model.__name__
+    return atlas_settings.GEOJSON_IN_DATABASE or \
+        entity in atlas_settings.GEOMETRY_SIMPLIFY or \
+        entity in atlas_settings.GEOMETRY_PRECISION
+
+
+def project_values(queryset, columns, geometries=()):
+    """
+    Returns the queryset reading only the given columns, and the given
+    geometry columns as GeoJSON, into ValuesRows.
+    """
+    queryset = queryset.values(*columns, **{
+        GEOJSON + name: geojson_expression(queryset.model, name)
+        for name in geometries
+    })
+    queryset._iterable_class = ValuesRowIterable
+    return queryset
+
+
+def is_loaded(queryset, name):
+    """
+    Whether a column is loaded by the queryset, given its only() and defer().
+    """
+    names, defer = queryset.query.deferred_loading
+    return name not in names if defer else name in names
+
+
+def annotate_geojson(queryset):
+    """
+    Returns the queryset loading the GeoJSON text of its geometry columns
+    instead of the geometries, see reads_geojson.
+    """
+    if not reads_geojson(queryset.model):
+        return queryset
+    geometries = [
+        field.name for field in queryset.model._meta.concrete_fields
+        if isinstance(field, GeometryField) and is_loaded(queryset, field.name)
+    ]
+    if not geometries:
+        return queryset
+    return queryset.defer(*geometries).annotate(**{
+        GEOJSON + name: geojson_expression(queryset.model, name)
+        for name in geometries
+    })
@@ -0,0 +1,118 @@
+"""
+JSON rendering of SensorThings responses.
+
+SensorThingsJSONRenderer encodes with orjson when it is installed and falls
+back to DRF's JSONRenderer otherwise. stream_json writes a collection
+response entity by entity for the STREAM_RESPONSES mode of ViewSet.list.
+"""
+import json
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils import encoders
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson 3.9 and later embed Fragments of JSON text as they are.
+Fragment = getattr(orjson, 'Fragment', None)
+
+
+def raw_json(text):
+    """
+    Returns JSON text, e.g. GeoJSON written by the database, to be embedded
+    in the response as it is where orjson allows it, or else its value.
+    """
+    if Fragment is not None:
+        return Fragment(text)
+    return json.loads(text)
+
+
+class SensorThingsJSONEncoder(encoders.JSONEncoder):
+    """
+    DRF's JSONEncoder, which also encodes orjson Fragments.
+    """
+    def default(self, obj):
+        if Fragment is not None and isinstance(obj, Fragment):
+            return json.loads(obj.contents)
+        return super(SensorThingsJSONEncoder, self).default(obj)
+
+
+def default(obj):
+    """
+    Encodes the types orjson does not know like DRF's JSONEncoder does,
+    e.g. Decimals and lazy translation strings.
+    """
+    return encoders.JSONEncoder().default(obj)
+
+
+def dumps(data):
+    """
+    Returns the compact UTF-8 JSON of data.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, default=default)
+        except TypeError:
+            # e.g. integers beyond 64 bits
+            pass
+    return json.dumps(
+        data,
+        cls=SensorThingsJSONEncoder,
+        ensure_ascii=False,
+        allow_nan=False,
+        separators=(',', ':')
+    ).encode('utf-8')
+
+
+class SensorThingsJSONRenderer(JSONRenderer):
+    """
+    Renders compact JSON with orjson where it is installed. Indented JSON,
+    as asked for by the browsable API, is rendered by DRF.
+    """
+    encoder_class = SensorThingsJSONEncoder
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        renderer_context = renderer_context or {}
+        if orjson is None or \
+                self.get_indent(accepted_media_type, renderer_context) is not None:
+            return super(SensorThingsJSONRenderer, self).render(
+                data, accepted_media_type, renderer_context)
+        return dumps(data)
+
+
+def stream_array(rows, render):
+    """
+    Yields the JSON array of rows in chunks, every row rendered and encoded
+    on its own.
+    """
+    yield b'['
+    comma = b''
+    for row in rows:
+        yield comma + dumps(render(row))
+        comma = b','
+    yield b']'
+
+
+def stream_json(envelope, key, rows, render):
+    """
+    Yields the JSON of a collection response in chunks: the members of the
+    envelope, with the array of rows streamed under key, so the whole
+    response is never held in memory at once. Without an envelope the bare
+    array is streamed.
+    """
+    if envelope is None:
+        yield from stream_array(rows, render)
+        return
+    yield b'{'
+    separator = b''
+    for name, value in envelope.items():
+        if name == key:
+            yield separator + dumps(name) + b':'
+            yield from stream_array(rows, render)
+        else:
+            yield separator + dumps(name) + b':' + dumps(value)
+        separator = b','
+    yield b'}'
@@ -0,0 +1,129 @@
+"""
+Routing of the reads of the API to read replicas.
+
+With READ_REPLICAS, the GET requests of the SensorThings views (lists,
+entities, association links and property values) read from one of the
+given databases, picked per request. Everything else, and every write, uses
+the primary 'default' database. A client that wrote is pinned to the primary
+for REPLICA_PIN_SECONDS, so that it reads its own writes, e.g. the entity
+at the Location header of one it created, before they reach the replicas.
+Clients are told apart by a cookie set on their writes, and authenticated
+ones also by their user, never by their address: behind a reverse proxy all
+the anonymous clients share one.
+
+Install the router in your project's settings.py:
+
+DATABASE_ROUTERS = ['sensorAtlas.replicas.ReplicaRouter']
+"""
+import random
+import threading
+
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework.permissions import SAFE_METHODS
+from .settings import atlas_settings
+
+
+APP_LABEL = 'sensorAtlas'
+PIN_KEY = 'sensoratlas:pin:%s'
+PIN_COOKIE = 'sensoratlas_primary'
+
+# The database the current request reads from, None for the primary.
+state = threading.local()
+
+
+def user_key(request):
+    """
+    Returns the key of the user of a request, or None if it is anonymous.
+    """
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return 'user:%s' % user.pk
+    return None
+
+
+def pin(request, response):
+    """
+    Pins the client of the request to the primary for REPLICA_PIN_SECONDS
+    with a cookie that expires with the pin. Users are also pinned in the
+    default cache, for clients that do not keep cookies; it must be shared
+    by the processes serving the API for them to see each other's pins.
+    """
+    seconds = atlas_settings.REPLICA_PIN_SECONDS
+    if not seconds:
+        return
+    response.set_cookie(PIN_COOKIE, '1', max_age=seconds, httponly=True, samesite='Lax')
+    key = user_key(request)
+    if key is not None:
+        cache.set(PIN_KEY % key, True, seconds)
+
+
+def is_pinned(request):
+    if PIN_COOKIE in request.COOKIES:
+        return True
+    key = user_key(request)
+    return key is not None and cache.get(PIN_KEY % key) is not None
+
+
+def read_database():
+    return getattr(state, 'database', None)
+
+
+def release(**kwargs):
+    """
+    request_finished receiver: reads after the request use the primary.
+    Streamed responses read until they are closed, so the database is only
+    released then.
+    """
+    state.database = None
+
+
+class ReplicaRouting:
+    """
+    View mixin that has the reads of GET requests go to a replica, unless the
+    client is pinned to the primary, and pins the clients of successful
+    writes.
+    """
+    def initial(self, request, *args, **kwargs):
+        state.database = None
+        super(ReplicaRouting, self).initial(request, *args, **kwargs)
+        replicas = atlas_settings.READ_REPLICAS
+        if replicas and request.method in SAFE_METHODS and not is_pinned(request):
+            state.database = random.choice(replicas)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(ReplicaRouting, self).finalize_response(
+            request, response, *args, **kwargs)
+        if atlas_settings.READ_REPLICAS and \
+                request.method not in SAFE_METHODS and response.status_code < 400:
+            pin(request, response)
+        return response
+
+
+class ReplicaRouter:
+    """
+    Database router of the sensorAtlas models: reads go to the replica
+    chosen for the request, writes to the primary. Other apps are left to
+    the next router.
+    """
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != APP_LABEL:
+            return None
+        return read_database()
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != APP_LABEL:
+            return None
+        # also for instances read from a replica
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *atlas_settings.READ_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in atlas_settings.READ_REPLICAS:
+            return False
+        return None
@@ -1,7 +1,8 @@
 from .models import Datastream, Thing, Sensor, Location, \
     ObservedProperty, Observation, HistoricalLocation, FeatureOfInterest
 from rest_framework import serializers
-from .mixins import Expand, Select, ResultFormat, ControlInformation
+from .mixins import Expand, ExpandListSerializer, Select, ResultFormat, \
+    ControlInformation
 from .errors import Conflicts
 
 
@@ -15,6 +16,7 @@ class FeatureOfInterestSerializer(ControlInformation, Select, Expand, ResultForm
 
     class Meta:
         model = FeatureOfInterest
+        list_serializer_class = ExpandListSerializer
         fields = (
             'id',
             'selfLink',
@@ -52,6 +54,7 @@ class HistoricalLocationSerializer(ControlInformation, Select, Expand, ResultFor
 
     class Meta:
         model = HistoricalLocation
+        list_serializer_class = ExpandListSerializer
         fields = (
             'id',
             'selfLink',
@@ -86,6 +89,7 @@ class LocationSerializer(ControlInformation, Select, Expand, ResultFormat, seria
 
     class Meta:
         model = Location
+        list_serializer_class = ExpandListSerializer
         fields = (
             'id',
             'selfLink',
@@ -127,6 +131,7 @@ class ThingSerializer(ControlInformation, Select, Expand, ResultFormat, serializ
 
     class Meta:
         model = Thing
+        list_serializer_class = ExpandListSerializer
         fields = (
             'id',
             'selfLink',
@@ -172,6 +177,7 @@ class SensorSerializer(ControlInformation, Select, Expand, ResultFormat, seriali
 
     class Meta:
         model = Sensor
+        list_serializer_class = ExpandListSerializer
         fields = (
             'id',
             'selfLink',
@@ -209,6 +215,7 @@ class ObservedPropertySerializer(ControlInformation, Select, Expand, ResultForma
 
     class Meta:
         model = ObservedProperty
+        list_serializer_class = ExpandListSerializer
         fields = (
             'id',
             'selfLink',
@@ -244,6 +251,7 @@ class ObservationSerializer(ControlInformation, Select, Expand, ResultFormat, se
 
     class Meta:
         model = Observation
+        list_serializer_class = ExpandListSerializer
         fields = (
             'id',
             'selfLink',
@@ -276,6 +284,7 @@ class DatastreamSerializer(ControlInformation, Select, Expand, ResultFormat, ser
 
     class Meta:
         model = Datastream
+        list_serializer_class = ExpandListSerializer
         fields = (
             'id',
             'selfLink',
@@ -0,0 +1,117 @@
+"""
+Settings for sensorAtlas are all namespaced in the SENSORATLAS setting.
+For example your project's `settings.py` file might look like this:
+
+SENSORATLAS = {
+    'TYPED_RESULTS': True,
+}
+
+Any setting that is not given falls back to the value in DEFAULTS.
+"""
+from django.conf import settings
+from django.core.signals import setting_changed
+
+
+DEFAULTS = {
+    # Filter Observation results on the typed result_number / result_text /
+    # result_bool columns instead of the JSON result column.
+    'TYPED_RESULTS': False,
+    # Defaults of the partition_observations management command: the number
+    # of future monthly partitions to create and the number of past months
+    # to keep (None keeps all partitions).
+    'PARTITION_PREMAKE': 3,
+    'PARTITION_RETENTION': None,
+    # Maximum number of parsed $filter plans kept in the per-process LRU
+    # cache. 0 disables the cache.
+    'FILTER_CACHE_SIZE': 256,
+    # Page list responses with $skiptoken cursors on the ordering key instead
+    # of $skip offsets.
+    'KEYSET_PAGINATION': False,
+    # Count the results of list requests that do not give $count. With False
+    # counting is opt-in with $count=true.
+    'COUNT_BY_DEFAULT': True,
+    # Results of at least this many rows, according to the planner, are
+    # counted with the estimate instead of COUNT(*). None always counts.
+    'COUNT_ESTIMATE_THRESHOLD': None,
+    # Number of rows the ObservationLoader copies per COPY statement.
+    'COPY_CHUNK_SIZE': 10000,
+    # Stream JSON list responses entity by entity instead of rendering the
+    # whole page at once.
+    'STREAM_RESPONSES': False,
+    # Number of rows fetched per round trip from the server-side cursor of
+    # unpaginated list requests, whose JSON responses are always streamed.
+    'ITERATOR_CHUNK_SIZE': 2000,
+    # Write the GeoJSON of geometries in the database with ST_AsGeoJSON, with
+    # at most GEOJSON_PRECISION decimal digits, and embed it in responses.
+    'GEOJSON_IN_DATABASE': False,
+    'GEOJSON_PRECISION': 8,
+    # Tolerance of ST_SimplifyPreserveTopology and number of decimal digits
+    # of the geometries read of an entity, by model name, e.g.
+    # {'FeatureOfInterest': 0.0001}.
+    'GEOMETRY_SIMPLIFY': {},
+    'GEOMETRY_PRECISION': {},
+    # Run the SELECTs the ORM sent more than this many times as prepared
+    # statements on PostgreSQL connections. None never prepares them.
+    'PREPARE_THRESHOLD': None,
+    # The database is reached through a pooler in transaction mode, e.g.
+    # pgbouncer with pool_mode = transaction: keep no session-level state.
+    'TRANSACTION_POOLING': False,
+    # Aliases of the databases GET requests read from with
+    # sensorAtlas.replicas.ReplicaRouter, and the number of seconds a client
+    # that wrote reads from the primary instead.
+    'READ_REPLICAS': [],
+    'REPLICA_PIN_SECONDS': 5,
+    # Model names of the entities whose GET responses are cached, e.g.
+    # ['Thing', 'Sensor', 'ObservedProperty', 'Location'], the alias in
+    # CACHES they are kept in and for how many seconds.
+    'CACHED_ENTITIES': [],
+    'RESPONSE_CACHE': 'default',
+    'RESPONSE_CACHE_TIMEOUT': 300,
+}
+
+
+class AtlasSettings:
+    """
+    A settings object that allows sensorAtlas settings to be accessed as
+    properties, e.g. `atlas_settings.TYPED_RESULTS`.
+    """
+    def __init__(self, defaults=None):
+        self.defaults = defaults or DEFAULTS
+        self._cached_attrs = set()
+
+    @property
+    def user_settings(self):
+        if not hasattr(self, '_user_settings'):
+            self._user_settings = getattr(settings, 'SENSORATLAS', {})
+        return self._user_settings
+
+    def __getattr__(self, attr):
+        if attr not in self.defaults:
+            raise AttributeError("Invalid sensorAtlas setting: '%s'" % attr)
+
+        try:
+            val = self.user_settings[attr]
+        except KeyError:
+            val = self.defaults[attr]
+
+        self._cached_attrs.add(attr)
+        setattr(self, attr, val)
+        return val
+
+    def reload(self):
+        for attr in self._cached_attrs:
+            delattr(self, attr)
+        self._cached_attrs.clear()
+        if hasattr(self, '_user_settings'):
+            delattr(self, '_user_settings')
+
+
+atlas_settings = AtlasSettings(DEFAULTS)
+
+
+def reload_atlas_settings(*args, **kwargs):
+    if kwargs['setting'] == 'SENSORATLAS':
+        atlas_settings.reload()
+
+
+setting_changed.connect(reload_atlas_settings)
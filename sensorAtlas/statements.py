@@ -0,0 +1,260 @@
+"""
+Prepared statements of the stable query shapes.
+
+The ORM passes every value of a query as a parameter, so requests of the
+same shape send the same SQL text: the retrieve of an entity by id, a page
+of the Observations of a Datastream in time order, or a $filter template
+with other literals. With PREPARE_THRESHOLD set, the SELECTs sent to
+PostgreSQL are counted by their text. Once a shape ran more often than the
+threshold, every connection that runs it again prepares it as a named
+statement and from then on only sends EXECUTE with the values, so that
+PostgreSQL can reuse its plan.
+
+statement_cache.cache_info() and statement_cache.shapes() report how often
+the shapes were executed and prepared, and prepared_statements() the plans
+PostgreSQL keeps for the statements of a connection.
+"""
+import hashlib
+import itertools
+import re
+import threading
+
+from collections import OrderedDict
+from django.conf import settings
+from django.core import checks
+from django.db import DatabaseError
+from .settings import atlas_settings
+
+
+# Number of query shapes counted per process, and of statements prepared per
+# connection. The least recently used are forgotten, respectively
+# deallocated, first.
+MAX_SHAPES = 1024
+MAX_STATEMENTS = 256
+
+PREFIX = 'sensoratlas_'
+PLACEHOLDER = re.compile(r'%([s%])')
+SAVEPOINT = 'sensoratlas_prepare'
+
+
+def parametrize(sql):
+    """
+    Returns the SQL of the ORM with numbered $n parameters, as PREPARE
+    expects them, and the number of parameters.
+    """
+    numbers = itertools.count(1)
+
+    def replace(match):
+        if match.group(1) == '%':
+            return '%'
+        return '$%d' % next(numbers)
+    statement = PLACEHOLDER.sub(replace, sql)
+    return statement, next(numbers) - 1
+
+
+class Shape:
+    """
+    A SELECT statement of the ORM and its counters.
+    """
+    def __init__(self, sql):
+        self.sql = sql
+        self.name = PREFIX + hashlib.sha1(sql.encode('utf-8')).hexdigest()[:20]
+        self.statement, self.parameters = parametrize(sql)
+        self.executions = 0
+        self.prepares = 0
+        self.prepared_executions = 0
+        self.failed = False
+
+
+class StatementCache:
+    """
+    A thread-safe LRU of the query shapes run by the process. cache_info()
+    reports its counters, like plan_cache in parsers.
+    """
+    def __init__(self, maxsize=MAX_SHAPES):
+        self.maxsize = maxsize
+        self.shapes_by_sql = OrderedDict()
+        self.lock = threading.Lock()
+
+    def count(self, sql):
+        """
+        Counts an execution of the SQL and returns its shape.
+        """
+        with self.lock:
+            shape = self.shapes_by_sql.get(sql)
+            if shape is None:
+                shape = self.shapes_by_sql[sql] = Shape(sql)
+                while len(self.shapes_by_sql) > self.maxsize:
+                    self.shapes_by_sql.popitem(last=False)
+            else:
+                self.shapes_by_sql.move_to_end(sql)
+            shape.executions += 1
+            return shape
+
+    def record(self, shape, prepares=0, prepared_executions=0, failed=False):
+        """
+        Adds to the counters of a shape.
+        """
+        with self.lock:
+            shape.prepares += prepares
+            shape.prepared_executions += prepared_executions
+            shape.failed = shape.failed or failed
+
+    def shapes(self):
+        """
+        Returns the counters of every shape, the most executed first.
+        """
+        with self.lock:
+            shapes = [
+                {
+                    'name': shape.name,
+                    'sql': shape.sql,
+                    'executions': shape.executions,
+                    'prepares': shape.prepares,
+                    'prepared_executions': shape.prepared_executions,
+                    'failed': shape.failed
+                }
+                for shape in self.shapes_by_sql.values()
+            ]
+        return sorted(shapes, key=lambda shape: -shape['executions'])
+
+    def cache_info(self):
+        with self.lock:
+            shapes = list(self.shapes_by_sql.values())
+            return {
+                'shapes': len(shapes),
+                'executions': sum(shape.executions for shape in shapes),
+                'prepares': sum(shape.prepares for shape in shapes),
+                'prepared_executions': sum(shape.prepared_executions for shape in shapes),
+                'maxsize': self.maxsize
+            }
+
+    def clear(self):
+        with self.lock:
+            self.shapes_by_sql.clear()
+
+
+statement_cache = StatementCache()
+
+
+def preparable(sql, params, many, context):
+    """
+    Whether the statement is a SELECT that may run as a prepared statement.
+    The SELECTs of server-side cursors are declared with the cursor instead.
+    """
+    return not many and \
+        isinstance(params, (list, tuple)) and \
+        sql.lstrip()[:6].upper() == 'SELECT' and \
+        getattr(context['cursor'].cursor, 'name', None) is None
+
+
+def prepare(execute, shape, context):
+    """
+    Prepares the shape on the connection. Returns False, and never tries
+    again, if PostgreSQL cannot prepare it, e.g. because it cannot infer the
+    type of a parameter. Inside a transaction a savepoint keeps the failure
+    from aborting it.
+    """
+    connection = context['connection']
+    statements = connection.prepared_statements
+    if len(statements) >= MAX_STATEMENTS:
+        name, _ = statements.popitem(last=False)
+        execute('DEALLOCATE %s' % name, None, False, context)
+    sql = 'PREPARE %s AS %s' % (shape.name, shape.statement)
+    atomic = connection.in_atomic_block
+    try:
+        if atomic:
+            execute('SAVEPOINT %s' % SAVEPOINT, None, False, context)
+        execute(sql, None, False, context)
+    except DatabaseError:
+        if atomic:
+            execute('ROLLBACK TO SAVEPOINT %s' % SAVEPOINT, None, False, context)
+        statement_cache.record(shape, failed=True)
+        return False
+    finally:
+        if atomic:
+            execute('RELEASE SAVEPOINT %s' % SAVEPOINT, None, False, context)
+    statements[shape.name] = shape
+    statement_cache.record(shape, prepares=1)
+    return True
+
+
+def execute_prepared(execute, sql, params, many, context):
+    """
+    Execute wrapper of the connections that runs the stable SELECT shapes as
+    prepared statements when PREPARE_THRESHOLD is set. Prepared statements
+    are session state, so TRANSACTION_POOLING turns them off.
+    """
+    threshold = atlas_settings.PREPARE_THRESHOLD
+    if threshold is None or atlas_settings.TRANSACTION_POOLING or \
+            not preparable(sql, params, many, context):
+        return execute(sql, params, many, context)
+    shape = statement_cache.count(sql)
+    if shape.failed or shape.executions <= threshold or \
+            shape.parameters != len(params):
+        return execute(sql, params, many, context)
+    statements = context['connection'].prepared_statements
+    if shape.name in statements:
+        statements.move_to_end(shape.name)
+    elif not prepare(execute, shape, context):
+        return execute(sql, params, many, context)
+    statement_cache.record(shape, prepared_executions=1)
+    if params:
+        sql = 'EXECUTE %s(%s)' % (shape.name, ', '.join(['%s'] * len(params)))
+    else:
+        sql = 'EXECUTE %s' % shape.name
+    return execute(sql, params, many, context)
+
+
+def install(sender, connection, **kwargs):
+    """
+    connection_created receiver that adds the execute wrapper to PostgreSQL
+    connections. Statements prepared on a former connection are gone.
+    """
+    if connection.vendor != 'postgresql':
+        return
+    connection.prepared_statements = OrderedDict()
+    if execute_prepared not in connection.execute_wrappers:
+        # Django applies the wrappers in reverse, so the last one appended is
+        # the innermost: the wrappers added before see the SQL of the ORM.
+        connection.execute_wrappers.append(execute_prepared)
+
+
+def check_persistent_connections(app_configs, **kwargs):
+    """
+    System check that warns when statements are prepared on PostgreSQL
+    connections that are closed after every request (CONN_MAX_AGE 0): they
+    would be prepared again on every request, which costs a round trip per
+    statement instead of saving one.
+    """
+    if atlas_settings.PREPARE_THRESHOLD is None:
+        return []
+    warnings = []
+    for alias, database in settings.DATABASES.items():
+        if 'postgis' not in database.get('ENGINE', '') and \
+                'postgresql' not in database.get('ENGINE', ''):
+            continue
+        if database.get('CONN_MAX_AGE', 0) == 0:
+            warnings.append(checks.Warning(
+                "PREPARE_THRESHOLD is set but the '%s' database closes its "
+                "connections after every request." % alias,
+                hint="Set CONN_MAX_AGE of the database, e.g. to 60, or unset "
+                     "PREPARE_THRESHOLD.",
+                id='sensorAtlas.W001',
+            ))
+    return warnings
+
+
+def prepared_statements(connection):
+    """
+    Returns the rows of pg_prepared_statements for the statements prepared on
+    the connection. From PostgreSQL 14 on they include the number of generic
+    and custom plans.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT * FROM pg_prepared_statements WHERE name LIKE %s",
+            [PREFIX + '%']
+        )
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
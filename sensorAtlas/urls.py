@@ -8,9 +8,16 @@ from .routers import SensorRouter
 from .routers import ObservedPropertyRouter
 from .routers import ObservationRouter
 from .routers import FeatureOfInterestRouter
+from .views import CreateObservations, LoadObservations
 
 
 urlpatterns = [
+    re_path(r'^(?P<version>(v1.0))/CreateObservations$',
+            CreateObservations.as_view(),
+            name='createobservations'),
+    re_path(r'^(?P<version>(v1.0))/LoadObservations$',
+            LoadObservations.as_view(),
+            name='loadobservations'),
     re_path(r'^(?P<version>(v1.0))/', include(
                      Router.router.urls
                     )),
@@ -1,4 +1,11 @@
-from collections import defaultdict
+import django
+from collections import OrderedDict, defaultdict
+from .errors import BadRequest
+
+
+# Django slices prefetch querysets per related object from 4.2 on. Before,
+# the nested $skip and $top of an $expand are applied to the prefetched list.
+PREFETCH_SLICING = django.VERSION >= (4, 2)
 
 
 def dict_from_qs(qs):
@@ -42,3 +49,78 @@ def qs_from_dict(qsdict, prefix=""):
     return ",".join(descend(qsdict))
 
 
+def split_top_level(string, separator):
+    """
+    Splits a string on a separator that is not inside parentheses or quotes
+    i.e. "a($top=1;$skip=2),b" => ["a($top=1;$skip=2)", "b"]
+    """
+    parts = []
+    depth = 0
+    quoted = False
+    start = 0
+    for index, character in enumerate(string):
+        if character == "'":
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif character == '(':
+            depth += 1
+        elif character == ')':
+            depth -= 1
+        elif character == separator and depth == 0:
+            parts.append(string[start:index])
+            start = index + 1
+    if depth != 0 or quoted:
+        raise BadRequest()
+    parts.append(string[start:])
+    return parts
+
+
+def parse_expand(qs, tree=None):
+    """
+    Parses an $expand query option into a tree of the expanded relations
+    with their nested query options
+    i.e. "Datastreams($top=1)/Sensor,Locations" =>
+    {"Datastreams": {"options": {"$top": "1"},
+                     "expand": {"Sensor": {"options": {}, "expand": {}}}},
+     "Locations": {"options": {}, "expand": {}}}
+    Nested $expand options are merged into the tree.
+    """
+    tree = OrderedDict() if tree is None else tree
+    entries = split_top_level(qs, ',') if qs.strip() else []
+    for entry in entries:
+        level = tree
+        for segment in split_top_level(entry.strip(), '/'):
+            name, options = segment.strip(), ''
+            if name.endswith(')') and '(' in name:
+                name, options = name[:-1].split('(', 1)
+            if not name:
+                raise BadRequest()
+            node = level.setdefault(name, {'options': {}, 'expand': OrderedDict()})
+            for option in split_top_level(options, ';'):
+                if not option.strip():
+                    continue
+                key, _, value = option.partition('=')
+                if key.strip() == '$expand':
+                    parse_expand(value, node['expand'])
+                else:
+                    node['options'][key.strip()] = value.strip()
+            level = node['expand']
+    return tree
+
+
+def expand_page(options):
+    """
+    Returns the slice of the nested $skip and $top options of an expanded
+    relation, or None if they are not given.
+    """
+    if '$skip' not in options and '$top' not in options:
+        return None
+    try:
+        skip = int(options.get('$skip', 0))
+        top = int(options['$top']) if '$top' in options else None
+    except ValueError:
+        raise BadRequest()
+    if skip < 0 or (top is not None and top < 0):
+        raise BadRequest()
+    return slice(skip, skip + top if top is not None else None)
@@ -3,7 +3,14 @@ from .models import Location, Thing, Datastream, Sensor, \
 import sensorAtlas.serializer as serializers
 from .parsers import Filter, Orderby
 from .viewsets import ViewSet
-from rest_framework import generics
+from .replicas import ReplicaRouting
+from .ingest import create_observations, ObservationLoader
+from .errors import BadRequest
+import codecs
+from rest_framework import generics, status
+from rest_framework.response import Response
+from rest_framework.reverse import reverse
+from rest_framework.views import APIView
 
 
 class APIRoot(generics.GenericAPIView):
@@ -74,3 +81,51 @@ class FeatureOfInterestView(Filter, ViewSet):
     serializer_class = serializers.FeatureOfInterestSerializer
     filter_backends = (Orderby,)
     ordering_fields = '__all__'
+
+
+class CreateObservations(ReplicaRouting, APIView):
+    """
+    Creates Observations in bulk with the dataArray extension. Responds with
+    the selfLink of every created Observation, or "error" for rows that could
+    not be created, in the order of the request.
+    """
+    def post(self, request, version):
+        observations = create_observations(request.data)
+        base = reverse('observation-list',
+                       kwargs={'version': version},
+                       request=request)
+        links = [
+            base + '(%s)' % observation.id if observation else 'error'
+            for observation in observations
+        ]
+        return Response(links, status=status.HTTP_201_CREATED)
+
+
+class LoadObservations(ReplicaRouting, APIView):
+    """
+    Streams a CSV (text/csv) or NDJSON (application/x-ndjson) body of
+    Observations into the database with COPY. Responds with the number of
+    created and skipped rows. Invalid rows fail the whole load unless the
+    skipInvalid query parameter is true.
+    """
+    formats = {
+        'text/csv': 'csv',
+        'application/x-ndjson': 'ndjson'
+    }
+
+    def post(self, request, version):
+        content_type = request.content_type.split(';')[0].strip()
+        if content_type not in self.formats or request.stream is None:
+            raise BadRequest()
+
+        loader = ObservationLoader(
+            skip_invalid=request.query_params.get('skipInvalid') == 'true'
+        )
+        loader.load(
+            codecs.iterdecode(request.stream, 'utf-8'),
+            self.formats[content_type]
+        )
+        return Response(
+            {'created': loader.created, 'skipped': loader.skipped},
+            status=status.HTTP_201_CREATED
+        )
@@ -3,12 +3,20 @@ from .models import Location, Thing, Datastream, Sensor, \
 from rest_framework.response import Response
 from rest_framework.decorators import action
 from rest_framework.reverse import reverse
+import itertools
 import json
+from django.db import transaction
+from django.db.models import prefetch_related_objects
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from rest_framework import viewsets
 from django.contrib.gis.geos import GEOSGeometry
 from rest_framework import status
 from .errors import Unprocessable, BadRequest
+from .caching import ResponseCaching
+from .renderers import stream_json
+from .replicas import ReplicaRouting
+from .settings import atlas_settings
 import dateutil.parser
 from django.core.exceptions import ObjectDoesNotExist, FieldError
 from django.apps import apps
@@ -171,17 +179,44 @@ def relate_parent(data, basename, url_kwargs):
     return data
 
 
+def featureofinterest_from_location(datastream):
+    """
+    Creates a FeatureOfInterest from the Location of the Thing of a
+    Datastream, for Observations that are created without one.
+    """
+    try:
+        location = datastream.Thing.Location.get(
+                    encodingType=DEFAULT_ENCODING
+                    )
+        featureofinterest = FeatureOfInterest.objects.create(
+                    name=location.name,
+                    description=location.description,
+                    encodingType=location.encodingType,
+                    feature=location.location
+        )
+        return featureofinterest
+    except ObjectDoesNotExist:
+        raise BadRequest()
+
+
+def normalize_result(data):
+    """
+    Wraps the result of an Observation for the JSON result column.
+    """
+    try:
+        result = data['result']
+    except KeyError:
+        raise BadRequest()
+    data['result'] = {'result': result}
+    return data
+
+
 def process_data(data, basename, url_kwargs):
     data = relate_parent(data, basename, url_kwargs)
     data = geojson_to_geos(data)
     data = parse_interval_time(data)
     if basename == 'observation':
-        try:
-            result = data['result']
-            data['result'] = {'result': result}
-            return data
-        except KeyError:
-            raise BadRequest()
+        return normalize_result(data)
     return data
 
 
@@ -337,22 +372,38 @@ class NestedViewSet:
             ds = self.data['Datastream']
             datastream = self.get_or_create_children(ds, "Datastream")
         if datastream:
-            try:
-                location = datastream.Thing.Location.get(
-                            encodingType=DEFAULT_ENCODING
-                            )
-                featureofinterest = FeatureOfInterest.objects.create(
-                            name=location.name,
-                            description=location.description,
-                            encodingType=location.encodingType,
-                            feature=location.location
-                )
-                return featureofinterest
-            except ObjectDoesNotExist:
-                raise BadRequest()
+            return featureofinterest_from_location(datastream)
+
 
+def iterate_chunks(queryset, chunk_size):
+    """
+    Yields the instances of a queryset in lists of chunk_size, read with
+    iterator(), i.e. a named cursor on PostgreSQL. The prefetch lookups of
+    the queryset are done per chunk, as iterator() skips them.
 
-class ViewSet(viewsets.ModelViewSet):
+    With TRANSACTION_POOLING the cursor is read inside a transaction, which
+    a pooler in transaction mode keeps on one server connection.
+    """
+    if atlas_settings.TRANSACTION_POOLING:
+        with transaction.atomic(using=queryset.db):
+            yield from read_chunks(queryset, chunk_size)
+    else:
+        yield from read_chunks(queryset, chunk_size)
+
+
+def read_chunks(queryset, chunk_size):
+    lookups = queryset._prefetch_related_lookups
+    iterator = queryset.prefetch_related(None).iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        if lookups:
+            prefetch_related_objects(chunk, *lookups)
+        yield chunk
+
+
+class ViewSet(ResponseCaching, ReplicaRouting, viewsets.ModelViewSet):
     """
     Overrides the DRF ModelViewSet methods of list, retrieve, and create, update.
     """
@@ -733,6 +784,7 @@ class ViewSet(viewsets.ModelViewSet):
         queryset = self.get_queryset().filter(**d)
 
         queryset = self.filter_queryset(queryset)
+        queryset = self.get_projection(request, queryset)
 
         page = self.paginate_queryset(queryset)
         single_link = ['Thing', 'Sensor', 'ObservedProperty', 'Datastream', 'FeatureOfInterest']
@@ -749,6 +801,8 @@ class ViewSet(viewsets.ModelViewSet):
                 location = get_object_or_404(queryset, pk=id)
                 serializer = self.get_serializer(location)
                 return Response(serializer.data)
+            elif self.stream_response(request):
+                return self.get_streaming_response(page)
             else:
                 serializer = self.get_serializer(page, many=True)
                 return self.get_paginated_response(serializer.data)
@@ -759,8 +813,60 @@ class ViewSet(viewsets.ModelViewSet):
             serializer = self.get_serializer(location)
             return Response(serializer.data)
         else:
-            serializer = self.get_serializer(queryset, many=True)
-            return Response(serializer.data)
+            return self.get_unpaginated_response(request, queryset)
+
+    def get_projection(self, request, queryset):
+        """
+        Reads only the selected columns of a $select request that expands
+        nothing, without building model instances.
+        """
+        params = request.query_params
+        if '$select' not in params or '$expand' in params:
+            return queryset
+        serializer = self.get_serializer(many=True).child
+        if not hasattr(serializer, 'project'):
+            return queryset
+        return serializer.project(queryset)
+
+    def stream_response(self, request):
+        """
+        Whether the list response is streamed, see STREAM_RESPONSES.
+        """
+        return atlas_settings.STREAM_RESPONSES and \
+            getattr(request.accepted_renderer, 'format', None) == 'json'
+
+    def get_streaming_response(self, page):
+        """
+        Returns a response that serializes and writes the entities of the
+        page one at a time.
+        """
+        serializer = self.get_serializer(many=True)
+        envelope = self.paginator.get_paginated_envelope(None)
+        return StreamingHttpResponse(
+            stream_json(envelope, 'value', page, serializer.child.to_representation),
+            content_type='application/json'
+        )
+
+    def get_unpaginated_response(self, request, queryset):
+        """
+        Returns all the entities of the queryset, read in chunks from a
+        server-side cursor and serialized chunk by chunk, so the model
+        instances of only one chunk are in memory at a time. JSON responses
+        are always streamed, so neither is the rendered response; other
+        renderers, e.g. the browsable API, get the whole list.
+        """
+        render = self.get_serializer(many=True).child.to_representation
+        rows = (
+            obj
+            for chunk in iterate_chunks(queryset, atlas_settings.ITERATOR_CHUNK_SIZE)
+            for obj in chunk
+        )
+        if getattr(request.accepted_renderer, 'format', None) == 'json':
+            return StreamingHttpResponse(
+                stream_json(None, None, rows, render),
+                content_type='application/json'
+            )
+        return Response([render(obj) for obj in rows])
 
     def retrieve(self, request, version, **kwargs):
         d = self.queryset_methods(kwargs)
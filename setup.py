@@ -22,13 +22,15 @@ setup(
     test_suite="runtests.runtests",
     python_requires=">=3.6",
     install_requires=[
-        'boolean.py>=3.6',
         'djangorestframework>=3.9',
-        'Django>=2.1',
+        'Django>=3.2',
         'psycopg2>=2.8.2',
         'djangorestframework-expander>=0.2.3',
         'python-dateutil>=2.8.0'
     ],
+    extras_require={
+        'orjson': ['orjson>=3.0'],
+    },
     classifiers=[
         'Environment :: Web Environment',
         'Framework :: Django',
@@ -0,0 +1,70 @@
+from rest_framework import status
+from rest_framework.test import APITestCase
+from django.core.cache import cache
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from sensorAtlas.models import Thing, Location
+from django.contrib.gis.geos import Point
+
+
+@override_settings(SENSORATLAS={'CACHED_ENTITIES': ['Thing', 'Location']})
+class ResponseCache(APITestCase):
+    """
+    Check that responses of the cached entities are served from the cache
+    until the entities change, with ETags.
+    """
+    def setUp(self):
+        cache.clear()
+        self.thing = Thing.objects.create(
+            name='Thing 1',
+            description='This is a thing',
+            properties={}
+            )
+
+    def test_cached(self):
+        response = self.client.get('/api/v1.0/Things?$top=1&$count=true')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+        # the same query options in another order
+        with self.assertNumQueries(0):
+            cached = self.client.get('/api/v1.0/Things?$count=true&$top=1')
+        self.assertEqual(cached.status_code, status.HTTP_200_OK)
+        self.assertEqual(cached['ETag'], etag)
+        self.assertEqual(cached.content, response.content)
+        self.assertEqual(cached['Content-Type'], response['Content-Type'])
+        self.assertEqual(cached['Vary'], response['Vary'])
+        self.assertEqual(cached['Allow'], response['Allow'])
+        self.assertIn('Accept', cached['Vary'])
+
+        not_modified = self.client.get('/api/v1.0/Things?$top=1&$count=true', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(not_modified['Vary'], response['Vary'])
+
+    def test_invalidated(self):
+        url = '/api/v1.0/Things(%d)' % self.thing.id
+        etag = self.client.get(url)['ETag']
+        self.thing.name = 'Thing 2'
+        self.thing.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['name'], 'Thing 2')
+        self.assertNotEqual(response['ETag'], etag)
+
+        url = '/api/v1.0/Things(%d)/Locations' % self.thing.id
+        self.assertEqual(len(self.client.get(url).json()['value']), 0)
+        location = Location.objects.create(
+            name='Location 1',
+            description='This is a location',
+            encodingType='application/vnd.geo+json',
+            location=Point(-114.133, 51.08, srid=4326)
+            )
+        self.thing.Location.add(location)
+        self.assertEqual(len(self.client.get(url).json()['value']), 1)
+
+    def test_not_cached(self):
+        url = '/api/v1.0/Things?$expand=Datastreams'
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        self.assertGreater(len(queries), 0)
@@ -1,10 +1,12 @@
 from rest_framework.reverse import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase
+from sensorAtlas.mixins import ControlInformation
 from sensorAtlas.models import Thing, Location, HistoricalLocation, \
     Datastream, Sensor, ObservedProperty, Observation, FeatureOfInterest
 from django.contrib.gis.geos import Point, Polygon
 from django.utils import timezone
+from unittest import mock
 
 
 # A.1.1 Conformance class: SensorThings API Entity Control Information
@@ -102,6 +104,35 @@ class A_1_1(APITestCase):
                     count += 1
             self.assertGreaterEqual(count, 1)
 
+    def test_link_templates(self):
+        ControlInformation.link_templates.clear()
+        with mock.patch('sensorAtlas.mixins.reverse', wraps=reverse) as reverse_mock:
+            response = self.client.get('/api/v1.0/Things')
+            self.client.get('/api/v1.0/Things')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # one detail link and three navigation links, whatever the page size
+        self.assertEqual(reverse_mock.call_count, 4)
+        thing = response.data['value'][0]
+        self.assertEqual(
+            thing['@iot.selfLink'],
+            'http://testserver' + reverse('thing-detail', kwargs={'pk': thing['@iot.id'], 'version': 'v1.0'})
+        )
+        self.assertEqual(
+            thing['Datastreams@iot.navigationLink'],
+            'http://testserver' + reverse('datastream-list', kwargs={'Things_pk': thing['@iot.id'], 'version': 'v1.0'})
+        )
+
+    def test_representation(self):
+        response = self.client.get('/api/v1.0/Locations?$expand=Things')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        location = response.data['value'][0]
+        self.assertEqual(list(location)[:2], ['@iot.id', '@iot.selfLink'])
+        self.assertTrue(list(location)[-1].endswith('@iot.navigationLink'))
+        self.assertEqual(response.json()['value'][0]['location'],
+                         {'type': 'Point', 'coordinates': [-114.133, 51.08]})
+        self.assertNotIn('Thing', location)
+        self.assertEqual(location['Things'][0]['name'], 'Temperature Monitoring System')
+
 
 class A_1_2(APITestCase):
     """
@@ -2,9 +2,18 @@ from rest_framework import status
 from rest_framework.test import APITestCase
 from sensorAtlas.models import Thing, Location, Datastream, Sensor, \
     ObservedProperty, Observation, FeatureOfInterest, HistoricalLocation
+from sensorAtlas.functions import parse_geometry
+from sensorAtlas.pagination import SensorThingsPagination, estimate_count
+from sensorAtlas.parsers import compile_filter, plan_cache, tokenize
 from django.contrib.gis.geos import Point, Polygon, LineString
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from operator import getitem
+from concurrent.futures import ThreadPoolExecutor
+import json
+from unittest import mock
 
 
 class A_2_1_1(APITestCase):
@@ -548,17 +557,122 @@ class A_2_1_2(APITestCase):
         self.assertEqual(len(response.data['value'][0]), 2)
         self.assertEqual(response.data['value'][0]['result'], 42)
 
-    # # this feature hasnt been implemented yet
-    # def test_expand_things_filter1(self):
-    #     query = '$expand=Datastreams($top=1)'
-    #     response = self.client.get('/api/v1.0/Things?' + query)
-    #     self.assertEqual(response.status_code, status.HTTP_200_OK)
+    def test_select_projection(self):
+        query = '$select=name,properties,selfLink'
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/v1.0/Things?' + query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(response.data['value'][0]), ['@iot.selfLink', 'name', 'properties'])
+        self.assertEqual(response.data['value'][0]['name'], 'Thing 1')
+        select = [q['sql'] for q in queries if '"properties"' in q['sql']]
+        self.assertTrue(select)
+        self.assertTrue(all('"description"' not in sql for sql in select))
 
-    # so return 501 for now
-    def test_expand_things_filter2(self):
+        query = '$select=name,location'
+        response = self.client.get('/api/v1.0/Locations?' + query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['value'][0]['location']['type'], 'Point')
+        self.assertEqual(response.data['value'][0]['name'], 'Location 1')
+
+    @override_settings(SENSORATLAS={'GEOJSON_IN_DATABASE': True, 'GEOJSON_PRECISION': 2})
+    def test_geojson_in_database(self):
+        query = '$top=1&$expand=FeatureOfInterest'
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/v1.0/Observations?' + query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(any('ST_AsGeoJSON' in q['sql'] for q in queries))
+        feature = response.json()['value'][0]['FeatureOfInterest']['feature']
+        self.assertEqual(feature['type'], 'Polygon')
+        self.assertEqual(feature['coordinates'][0][1], [0, 50])
+
+        response = self.client.get('/api/v1.0/Locations')
+        self.assertEqual(response.json()['value'][0]['location'],
+                         {'type': 'Point', 'coordinates': [954158.1, 4215137.1]})
+
+    @override_settings(SENSORATLAS={'GEOMETRY_SIMPLIFY': {'FeatureOfInterest': 1.0},
+                                    'GEOMETRY_PRECISION': {'FeatureOfInterest': 0}})
+    def test_geometry_simplify(self):
+        FeatureOfInterest.objects.create(
+            name='Jagged',
+            description='this is a jagged place',
+            encodingType='application/vnd.geo+json',
+            feature=Polygon(((0.0, 0.0), (0.0, 25.2), (0.1, 50.0), (50.0, 50.0), (50.0, 0.0), (0.0, 0.0)))
+            )
+        response = self.client.get("/api/v1.0/FeaturesOfInterest?$filter=name eq 'Jagged'")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        feature = response.json()['value'][0]['feature']
+        self.assertEqual(feature['coordinates'], [[[0, 0], [0, 50], [50, 50], [50, 0], [0, 0]]])
+
+        response = self.client.get("/api/v1.0/Observations?$top=1&$expand=FeatureOfInterest")
+        feature = response.json()['value'][0]['FeatureOfInterest']['feature']
+        self.assertEqual(len(feature['coordinates'][0]), 5)
+
+        response = self.client.get('/api/v1.0/Locations')
+        self.assertEqual(response.json()['value'][0]['location']['coordinates'], [954158.1, 4215137.1])
+
+    def test_expand_things_filter1(self):
         query = '$expand=Datastreams($top=1)'
         response = self.client.get('/api/v1.0/Things?' + query)
-        self.assertEqual(response.status_code, status.HTTP_501_NOT_IMPLEMENTED)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['value'][0]['Datastreams']), 1)
+        self.assertEqual(response.data['value'][0]['Datastreams'][0]['name'], 'Chunt')
+
+    def test_expand_things_filter2(self):
+        query = "$expand=Datastreams($filter=name eq 'Spintax';$expand=Observations($orderby=phenomenonTime desc;$top=2))"
+        response = self.client.get('/api/v1.0/Things?' + query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        datastreams = response.data['value'][0]['Datastreams']
+        self.assertEqual(len(datastreams), 1)
+        self.assertEqual(datastreams[0]['name'], 'Spintax')
+        self.assertEqual([o['result'] for o in datastreams[0]['Observations']], ['Truth', 'Truth'])
+        self.assertEqual(datastreams[0]['Observations'][0]['phenomenonTime'][:19], '2019-02-07T19:08:00')
+
+    def test_expand_page_in_sql(self):
+        # the nested $skip and $top bound the query of the expanded entities
+        query = '$expand=Datastreams($expand=Observations($orderby=phenomenonTime desc;$skip=1;$top=2))'
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/v1.0/Things?' + query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(any('ROW_NUMBER()' in q['sql'] for q in queries))
+        datastreams = response.data['value'][0]['Datastreams']
+        self.assertEqual(len(datastreams), 2)
+        for datastream in datastreams:
+            expected = Observation.objects.filter(
+                Datastream__name=datastream['name']
+            ).order_by('-phenomenonTime')[1:3]
+            self.assertEqual([o['@iot.id'] for o in datastream['Observations']],
+                             [o.id for o in expected])
+
+    def test_expand_things_filter3(self):
+        query = '$select=name&$expand=Datastreams($select=name,unitOfMeasurement;$expand=Sensor($select=name))'
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/v1.0/Things?' + query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        thing = response.data['value'][0]
+        self.assertEqual(list(thing), ['name', 'Datastreams'])
+        self.assertEqual(list(thing['Datastreams'][0]), ['name', 'unitOfMeasurement', 'Sensor'])
+        self.assertEqual(thing['Datastreams'][0]['Sensor'], {'name': 'Temperature Sensor'})
+        self.assertTrue(all('"properties"' not in q['sql'] for q in queries))
+        self.assertTrue(all('"metadata"' not in q['sql'] for q in queries))
+
+    def test_expand_queries(self):
+        query = '$expand=Datastreams/Observations,Locations'
+        with CaptureQueriesContext(connection) as one_thing:
+            response = self.client.get('/api/v1.0/Things?' + query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        for name in ('Thing 2', 'Thing 3'):
+            thing = Thing.objects.create(name=name, description='This is a thing', properties={})
+            thing.Location.add(Location.objects.get(name='Location 1'))
+            datastream = Datastream.objects.get(name='Chunt')
+            datastream.pk = None
+            datastream.Thing = thing
+            datastream.save()
+        with CaptureQueriesContext(connection) as three_things:
+            response = self.client.get('/api/v1.0/Things?' + query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['value']), 3)
+        self.assertEqual(len(three_things), len(one_thing))
 
 
 class A_2_1_3(APITestCase):
@@ -1060,6 +1174,55 @@ class A_2_1_5(APITestCase):
         self.assertEqual(response.data['@iot.count'], 1)
 
 
+    @override_settings(SENSORATLAS={'COUNT_BY_DEFAULT': False})
+    def test_count_opt_in(self):
+        response = self.client.get('/api/v1.0/Observations?$top=5')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertRaises(KeyError, getitem, response.data, '@iot.count')
+        self.assertEqual(len(response.data['value']), 5)
+        self.assertIn('%24skip=5', response.data['@iot.nextLink'])
+
+        response = self.client.get('/api/v1.0/Observations?$skip=5&$top=5')
+        self.assertRaises(KeyError, getitem, response.data, '@iot.nextLink')
+
+        response = self.client.get('/api/v1.0/Observations?$count=true')
+        self.assertEqual(response.data['@iot.count'], 10)
+
+    @override_settings(SENSORATLAS={'COUNT_ESTIMATE_THRESHOLD': 1000000})
+    def test_count_estimate_threshold(self):
+        response = self.client.get('/api/v1.0/Observations?$filter=result eq 42')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['@iot.count'], 1)
+        self.assertFalse(response.data['@sensorAtlas.countEstimated'])
+
+        with override_settings(SENSORATLAS={'COUNT_ESTIMATE_THRESHOLD': 0}):
+            response = self.client.get('/api/v1.0/Observations?$filter=result eq 42')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['@sensorAtlas.countEstimated'])
+
+    @override_settings(SENSORATLAS={'COUNT_ESTIMATE_THRESHOLD': 0})
+    def test_count_estimate_below(self):
+        # an estimate below the real count does not cut the pages short
+        with mock.patch('sensorAtlas.pagination.estimate_count', return_value=2):
+            response = self.client.get('/api/v1.0/Observations?$top=3&$skip=3')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['@iot.count'], 2)
+        self.assertTrue(response.data['@sensorAtlas.countEstimated'])
+        self.assertEqual(len(response.data['value']), 3)
+        self.assertIn('%24skip=6', response.data['@iot.nextLink'])
+
+        with mock.patch('sensorAtlas.pagination.estimate_count', return_value=2):
+            response = self.client.get('/api/v1.0/Observations?$top=3&$skip=9')
+        self.assertEqual(len(response.data['value']), 1)
+        self.assertRaises(KeyError, getitem, response.data, '@iot.nextLink')
+
+    def test_count_estimate_not_analyzed(self):
+        # the test table was never analyzed, so it is estimated from the plan
+        estimate = estimate_count(Observation.objects.all())
+        self.assertIsInstance(estimate, int)
+        self.assertGreater(estimate, 0)
+
+
 class A_2_1_6(APITestCase):
     """
     Check if the service supports the $filter query option and the built-in
@@ -1546,7 +1709,31 @@ class A_2_1_6(APITestCase):
     def test_filter_operations_group4(self):
         query = "$filter=(result sub 5) gt 10"
         response = self.client.get("/api/v1.0/Observations?" + query)
-        self.assertEqual(response.status_code, status.HTTP_501_NOT_IMPLEMENTED)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['value']), 4)
+        self.assertEqual(response.data['value'][0]['result'], 42)
+
+    def test_filter_operations_arithmetic(self):
+        query = "$filter=result mul 2 sub 10 ge 60 and (id ge 1 or (not result eq 42))"
+        response = self.client.get("/api/v1.0/Observations?" + query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['value']), 2)
+        self.assertEqual(response.data['value'][0]['result'], 42)
+
+    def test_filter_operations_arithmetic_literals(self):
+        query = "$filter=result eq 5 mul 7"
+        response = self.client.get("/api/v1.0/Observations?" + query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['value']), 1)
+        self.assertEqual(response.data['value'][0]['result'], 35)
+
+    def test_filter_operations_long_or(self):
+        ids = Observation.objects.values_list('id', flat=True)
+        query = "$filter=" + " or ".join("id eq %d" % i for i in range(-2000, 0)) + \
+            " or id eq %d" % min(ids)
+        response = self.client.get("/api/v1.0/Observations?" + query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['value']), 1)
 
     # FUNCTION TESTS: req 31
     def test_filter_functions_substringof1(self):
@@ -1729,6 +1916,19 @@ class A_2_1_6(APITestCase):
         self.assertGreaterEqual(len(response.data['value']), 10)
         self.assertEqual(response.data['value'][0]['result'], 42)
 
+    def test_filter_functions_date_range(self):
+        # date() of a DateTimeField is a range on the field, of anything else
+        # a cast
+        query = str(compile_filter('date(phenomenonTime) eq 2019-03-24', Observation)[0])
+        self.assertIn('phenomenonTime__gte', query)
+        self.assertNotIn('__date', query)
+        query = str(compile_filter('date(result) eq 2019-03-24', Observation)[0])
+        self.assertIn('result__result__date', query)
+        self.assertNotIn('__gte', query)
+        query = str(compile_filter('date(phenomenonTime) eq 2019-03-24', Datastream)[0])
+        self.assertIn('phenomenonTime__date', query)
+        self.assertNotIn('__gte', query)
+
     def test_filter_functions_time1(self):
         query = "time(phenomenonTime) eq 04:05:00Z"
         response = self.client.get("/api/v1.0/Observations?$filter=" + query)
@@ -1800,6 +2000,46 @@ class A_2_1_6(APITestCase):
         response = self.client.get("/api/v1.0/Observations?$filter=" + query)
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_filter_operations_functions_and(self):
+        query = "$filter=round(result) eq 16 and floor(result) eq 15"
+        response = self.client.get("/api/v1.0/Observations?" + query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['value']), 1)
+        self.assertEqual(response.data['value'][0]['result'], 15.7)
+
+    def test_filter_compiler_threads(self):
+        filters = ["result eq %d or id gt %d" % (i, i) for i in range(50)]
+        expected = [str(compile_filter(f, Observation)[0]) for f in filters]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            compiled = list(executor.map(
+                lambda f: str(compile_filter(f, Observation)[0]), filters))
+        self.assertEqual(compiled, expected)
+
+    def test_filter_literals(self):
+        tokens, literals = tokenize('name eq "x" and id eq 1e5 or result eq 1.')
+        self.assertEqual(literals, ['"x"', '1e5', '1.'])
+        self.assertEqual(tokens[2], ('literal', 0))
+        for query in ('$filter=result eq "Lie"', '$filter=result eq 4.2e1'):
+            response = self.client.get("/api/v1.0/Observations?" + query)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(len(response.data['value']), 1)
+        self.assertEqual(response.data['value'][0]['result'], 42)
+        response = self.client.get("/api/v1.0/Observations?$filter=result eq 42.")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['value']), 1)
+
+    def test_filter_plan_cache(self):
+        plan_cache.clear()
+        for value in (35, 42):
+            query = "$filter=result eq %d" % value
+            response = self.client.get("/api/v1.0/Observations?" + query)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(len(response.data['value']), 1)
+            self.assertEqual(response.data['value'][0]['result'], value)
+        info = plan_cache.cache_info()
+        self.assertEqual(info['misses'], 1)
+        self.assertEqual(info['hits'], 1)
+
     def test_nested_filter_operations_eq(self):
         datastream = Datastream.objects.get(name='Spintax')
         query = '$filter=result eq Lie'
@@ -2037,6 +2277,60 @@ class A_2_1_6(APITestCase):
         self.assertEqual(len(response.data['value']), 0)
 
 
+    def test_filter_spatial_distance(self):
+        point = "geography'SRID=4326;POINT(135.605054 34.619524)'"
+        query = "$filter=geo.distance(location, %s) le 0" % point
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/v1.0/Locations?" + query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        within = [entity['name'] for entity in response.data['value']]
+        self.assertIn('Location 4', within)
+        self.assertTrue(any('ST_DWithin' in q['sql'] for q in queries))
+
+        query = "$filter=0 ge geo.distance(location, %s)" % point
+        response = self.client.get("/api/v1.0/Locations?" + query)
+        self.assertEqual([entity['name'] for entity in response.data['value']], within)
+
+        query = "$filter=geo.distance(location, %s) lt 0" % point
+        response = self.client.get("/api/v1.0/Locations?" + query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['value']), 0)
+
+        query = "$filter=geo.distance(location, %s) gt 0" % point
+        response = self.client.get("/api/v1.0/Locations?" + query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['value']) + len(within), 13)
+        self.assertNotIn('Location 4', [entity['name'] for entity in response.data['value']])
+
+    def test_filter_spatial_distance_srid(self):
+        # Location 4 in web mercator
+        point = "geography'SRID=3857;POINT(15095485.5603 4112295.4348)'"
+        query = "$filter=geo.distance(location, %s) le 0.00001" % point
+        response = self.client.get("/api/v1.0/Locations?" + query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('Location 4', [entity['name'] for entity in response.data['value']])
+
+        query = "$filter=geo.distance(location, %s) lt 0.00001" % point
+        response = self.client.get("/api/v1.0/Locations?" + query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('Location 4', [entity['name'] for entity in response.data['value']])
+
+        query = "$filter=geo.distance(location, %s) gt 0.00001" % point
+        response = self.client.get("/api/v1.0/Locations?" + query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('Location 4', [entity['name'] for entity in response.data['value']])
+
+    def test_filter_spatial_literal_cache(self):
+        parse_geometry.cache_clear()
+        query = "$filter=st_within(location, geography'SRID=4326;POINT(95.222 42.22)')"
+        for _ in range(2):
+            response = self.client.get("/api/v1.0/Locations?" + query)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        info = parse_geometry.cache_info()
+        self.assertEqual(info.misses, 1)
+        self.assertEqual(info.hits, 1)
+
+
 class A_2_1_7(APITestCase):
     """
     Check if the service supports the server-driven pagination as defined in
@@ -2065,3 +2359,81 @@ class A_2_1_7(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertRaises(KeyError, getitem, response.data, '@iot.nextLink')
         self.assertEqual(len(response.data['value']), 50)
+
+    @override_settings(SENSORATLAS={'KEYSET_PAGINATION': True})
+    def test_pagination_keyset(self):
+        for i in range(1, 151):
+            Thing.objects.create(
+                name='Thing %03d' % i,
+                description='This is a thing',
+                properties={}
+                )
+        page1 = self.client.get("/api/v1.0/Things?$orderby=name desc")
+        self.assertEqual(page1.status_code, status.HTTP_200_OK)
+        self.assertIn('%24skiptoken', page1.data['@iot.nextLink'])
+        self.assertEqual(len(page1.data['value']), 100)
+        self.assertEqual(page1.data['value'][0]['name'], 'Thing 150')
+
+        page2 = self.client.get(page1.data['@iot.nextLink'])
+        self.assertEqual(page2.status_code, status.HTTP_200_OK)
+        self.assertRaises(KeyError, getitem, page2.data, '@iot.nextLink')
+        self.assertEqual(len(page2.data['value']), 50)
+        self.assertEqual(page2.data['value'][0]['name'], 'Thing 050')
+        self.assertEqual(page2.data['@iot.count'], 150)
+
+        response = self.client.get("/api/v1.0/Things?$skiptoken=invalid")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(SENSORATLAS={'STREAM_RESPONSES': True})
+    def test_pagination_streaming(self):
+        for i in range(1, 151):
+            Thing.objects.create(
+                name='Thing ' + str(i),
+                description='This is a thing',
+                properties={}
+                )
+        response = self.client.get('/api/v1.0/Things')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        page1 = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(list(page1), ['@iot.count', 'value', '@iot.nextLink'])
+        self.assertEqual(page1['@iot.count'], 150)
+        self.assertEqual(len(page1['value']), 100)
+        self.assertEqual(page1['value'][0]['name'], 'Thing 1')
+        self.assertIn('@iot.selfLink', page1['value'][0])
+
+        response = self.client.get(page1['@iot.nextLink'])
+        page2 = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(len(page2['value']), 50)
+
+    @override_settings(SENSORATLAS={'ITERATOR_CHUNK_SIZE': 7})
+    def test_unpaginated_chunks(self):
+        location = Location.objects.create(
+            name='Location 1',
+            description='This is a location',
+            encodingType='application/vnd.geo+json',
+            location=Point(-114.133, 51.08, srid=4326)
+            )
+        for i in range(1, 151):
+            thing = Thing.objects.create(
+                name='Thing ' + str(i),
+                description='This is a thing',
+                properties={}
+                )
+            thing.Location.add(location)
+        with mock.patch.object(SensorThingsPagination, 'default_limit', None), \
+                override_settings(SENSORATLAS={'ITERATOR_CHUNK_SIZE': 7}):
+            response = self.client.get('/api/v1.0/Things?$expand=Locations')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            content = iter(response.streaming_content)
+            # the opening bracket and the entities of the first chunk are
+            # rendered before the next chunks are read
+            with CaptureQueriesContext(connection) as first:
+                head = [next(content) for _ in range(8)]
+            with CaptureQueriesContext(connection) as rest:
+                tail = list(content)
+            self.assertLess(len(first), len(rest))
+        things = json.loads(b''.join(head + tail))
+        self.assertEqual(len(things), 150)
+        self.assertEqual(things[0]['Locations'][0]['name'], 'Location 1')
+        self.assertEqual(things[149]['Locations'][0]['name'], 'Location 1')
@@ -19,3 +19,177 @@
 #         query = '$resultFormat=dataArray'
 #         response = self.client.get('/api/v1.0/FeaturesOfInterest?' + query)
 #         self.assertEqual(response.status_code, status.HTTP_501_NOT_IMPLEMENTED)
+
+
+from rest_framework import status
+from rest_framework.test import APITestCase
+from sensorAtlas.models import Thing, Location, Datastream, Sensor, \
+    ObservedProperty, Observation, FeatureOfInterest
+from django.contrib.gis.geos import Point, Polygon
+from sensorAtlas.ingest import ObservationLoader
+
+
+class SensorThingsAPICreateObservationsDataArray(APITestCase):
+    """
+    Check if the service supports the creation of Observations with the
+    dataArray extension of the CreateObservations request.
+    """
+    def setUp(self):
+        """
+        Create test resources
+        """
+        location = Location.objects.create(
+            name='Location 1',
+            description='This is a location',
+            encodingType='application/vnd.geo+json',
+            location=Point(-114.133, 51.08, srid=4326)
+            )
+        thing = Thing.objects.create(
+            name='Thing 1',
+            description='This is a thing',
+            properties={}
+            )
+        thing.Location.add(location)
+        self.feature = FeatureOfInterest.objects.create(
+            name='Usidore',
+            description='this is a place',
+            encodingType='application/vnd.geo+json',
+            feature=Polygon(((0.0, 0.0),
+                             (0.0, 50.0),
+                             (50.0, 50.0),
+                             (50.0, 0.0),
+                             (0.0, 0.0))
+                            ))
+        self.datastream = Datastream.objects.create(
+            name='Chunt',
+            description='Bing Bong',
+            observationType="http://www.opengis.net/def/observationType/OGC-OM/2.0/OM_Measurement",
+            unitOfMeasurement={},
+            Thing=thing,
+            Sensor=Sensor.objects.create(
+                name='Temperature Sensor',
+                description='This is a sensor test',
+                encodingType='PDF',
+                metadata='This is some very descriptive metadata.'
+                ),
+            ObservedProperty=ObservedProperty.objects.create(
+                name='Temperature',
+                definition='https://wikipedia.org',
+                description='This is a test'
+                )
+            )
+
+    def test_create_observations(self):
+        data = [{
+            "Datastream": {"@iot.id": self.datastream.id},
+            "components": ["phenomenonTime", "result", "FeatureOfInterest/id"],
+            "dataArray@iot.count": 3,
+            "dataArray": [
+                ["2017-02-07T18:02:00.000Z", 21.6, self.feature.id],
+                ["2017-02-07T18:03:00.000Z", 21.7, self.feature.id],
+                ["not a time", 21.8, self.feature.id]
+            ]
+        }]
+        response = self.client.post('/api/v1.0/CreateObservations', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data), 3)
+        self.assertEqual(response.data[2], 'error')
+        self.assertEqual(Observation.objects.count(), 2)
+        observation = Observation.objects.get(result__result=21.7)
+        self.assertTrue(response.data[1].endswith('/Observations(%d)' % observation.id))
+        self.assertEqual(observation.result_number, 21.7)
+        self.assertEqual(observation.FeatureOfInterest, self.feature)
+
+    def test_create_observations_without_feature(self):
+        data = [{
+            "Datastream": {"@iot.id": self.datastream.id},
+            "components": ["phenomenonTime", "result"],
+            "dataArray": [
+                ["2017-02-07T18:02:00.000Z", 21.6],
+                ["2017-02-07T18:03:00.000Z", 21.7]
+            ]
+        }]
+        response = self.client.post('/api/v1.0/CreateObservations', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Observation.objects.count(), 2)
+        self.assertEqual(FeatureOfInterest.objects.count(), 2)
+        self.assertEqual(Observation.objects.values('FeatureOfInterest').distinct().count(), 1)
+
+    def test_create_observations_bad_request(self):
+        data = [{
+            "Datastream": {"@iot.id": self.datastream.id},
+            "components": ["phenomenonTime", "unknown"],
+            "dataArray": [["2017-02-07T18:02:00.000Z", 21.6]]
+        }]
+        response = self.client.post('/api/v1.0/CreateObservations', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Observation.objects.count(), 0)
+
+    def test_create_observations_unknown_datastream(self):
+        data = [{
+            "Datastream": {"@iot.id": self.datastream.id + 1},
+            "components": ["phenomenonTime", "result"],
+            "dataArray": [["2017-02-07T18:02:00.000Z", 21.6]]
+        }]
+        response = self.client.post('/api/v1.0/CreateObservations', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(Observation.objects.count(), 0)
+        self.assertEqual(FeatureOfInterest.objects.count(), 1)
+
+    def test_create_observations_invalid_without_feature(self):
+        data = [{
+            "Datastream": {"@iot.id": self.datastream.id},
+            "components": ["phenomenonTime", "result"],
+            "dataArray": [["not a time", 21.6], ["2017-02-07T18:02:00.000Z"]]
+        }]
+        response = self.client.post('/api/v1.0/CreateObservations', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data, ['error', 'error'])
+        self.assertEqual(FeatureOfInterest.objects.count(), 1)
+
+    def test_load_observations_csv(self):
+        data = (
+            'Datastream/id,phenomenonTime,result,FeatureOfInterest/id\n'
+            '%(ds)d,2017-02-07T18:02:00.000Z,21.6,%(foi)d\n'
+            '%(ds)d,2017-02-07T18:03:00.000Z,21.7,%(foi)d\n'
+        ) % {'ds': self.datastream.id, 'foi': self.feature.id}
+        response = self.client.post('/api/v1.0/LoadObservations', data, content_type='text/csv')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data, {'created': 2, 'skipped': 0})
+        observation = Observation.objects.get(result__result=21.7)
+        self.assertEqual(observation.result_number, 21.7)
+        self.assertEqual(observation.FeatureOfInterest, self.feature)
+        self.assertIsNone(observation.resultTime)
+
+    def test_load_observations_null_text(self):
+        self.datastream.observationType = \
+            "http://www.opengis.net/def/observationType/OGC-OM/2.0/OM_CategoryObservation"
+        self.datastream.save()
+        loader = ObservationLoader()
+        loader.load([
+            'Datastream/id,phenomenonTime,result,FeatureOfInterest/id\n',
+            '%d,2017-02-07T18:02:00.000Z,"""\\\\N""",%d\n' % (
+                self.datastream.id, self.feature.id)
+        ])
+        self.assertEqual(loader.created, 1)
+        observation = Observation.objects.get()
+        self.assertEqual(observation.result, {'result': '\\N'})
+        self.assertEqual(observation.result_text, '\\N')
+        self.assertIsNone(observation.result_number)
+        self.assertIsNone(observation.resultQuality)
+
+    def test_load_observations_ndjson_invalid(self):
+        data = (
+            '{"Datastream": {"@iot.id": %(ds)d}, "phenomenonTime": "2017-02-07T18:02:00.000Z", "result": 21.6}\n'
+            '{"Datastream": {"@iot.id": %(ds)d}, "phenomenonTime": "not a time", "result": 21.7}\n'
+        ) % {'ds': self.datastream.id}
+        response = self.client.post('/api/v1.0/LoadObservations', data,
+                                    content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(Observation.objects.count(), 0)
+
+        response = self.client.post('/api/v1.0/LoadObservations?skipInvalid=true', data,
+                                    content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data, {'created': 1, 'skipped': 1})
+        self.assertEqual(Observation.objects.count(), 1)
@@ -0,0 +1,80 @@
+from io import StringIO
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TransactionTestCase
+from sensorAtlas.models import Thing, Datastream, Sensor, ObservedProperty, \
+    Observation, FeatureOfInterest
+from django.contrib.gis.geos import Polygon
+
+
+class PartitionObservations(TransactionTestCase):
+    """
+    Check that --convert splits the existing Observations into monthly
+    partitions and leaves the default partition empty.
+    """
+    def setUp(self):
+        """
+        Create test resources
+        """
+        feature = FeatureOfInterest.objects.create(
+            name='Usidore',
+            description='this is a place',
+            encodingType='application/vnd.geo+json',
+            feature=Polygon(((0.0, 0.0),
+                             (0.0, 50.0),
+                             (50.0, 50.0),
+                             (50.0, 0.0),
+                             (0.0, 0.0))
+                            ))
+        datastream = Datastream.objects.create(
+            name='Chunt',
+            description='Bing Bong',
+            observationType="http://www.opengis.net/def/observationType/OGC-OM/2.0/OM_Measurement",
+            unitOfMeasurement={},
+            Thing=Thing.objects.create(
+                name='Thing 1',
+                description='This is a thing',
+                properties={}
+                ),
+            Sensor=Sensor.objects.create(
+                name='Temperature Sensor',
+                description='This is a sensor test',
+                encodingType='PDF',
+                metadata='This is some very descriptive metadata.'
+                ),
+            ObservedProperty=ObservedProperty.objects.create(
+                name='Temperature',
+                definition='https://wikipedia.org',
+                description='This is a test'
+                )
+            )
+        for i, time in enumerate(['2019-01-31T23:59:59+00:00',
+                                  '2019-02-01T00:00:00+00:00',
+                                  '2019-02-14T12:00:00+00:00',
+                                  '2019-04-07T19:00:00+00:00']):
+            Observation.objects.create(
+                phenomenonTime=time,
+                result=i,
+                Datastream=datastream,
+                FeatureOfInterest=feature
+                )
+
+    def rows(self, table):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM %s' % connection.ops.quote_name(table))
+            return cursor.fetchone()[0]
+
+    def test_convert(self):
+        table = Observation._meta.db_table
+        with transaction.atomic():
+            call_command('partition_observations', convert=True, premake=0,
+                         stdout=StringIO())
+            self.assertEqual(self.rows(table + '_p2019_01'), 1)
+            self.assertEqual(self.rows(table + '_p2019_02'), 2)
+            self.assertEqual(self.rows(table + '_p2019_04'), 1)
+            self.assertEqual(self.rows(table + '_default'), 0)
+            self.assertEqual(Observation.objects.count(), 4)
+            self.assertEqual(
+                Observation.objects.filter(phenomenonTime__month=2).count(), 2)
+            # the conversion is undone with the test
+            transaction.set_rollback(True)
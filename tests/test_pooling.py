@@ -0,0 +1,115 @@
+from rest_framework import status
+from rest_framework.test import APITransactionTestCase
+from django.db import connection
+from django.test import override_settings
+from sensorAtlas.models import Thing, Location, Datastream, Sensor, \
+    ObservedProperty, Observation, FeatureOfInterest
+from sensorAtlas.pagination import SensorThingsPagination
+from sensorAtlas.statements import statement_cache
+from django.contrib.gis.geos import Point, Polygon
+from unittest import mock
+import json
+
+
+def discard_session(execute, sql, params, many, context):
+    """
+    Stands in for a pooler in transaction mode, which may hand every
+    transaction another server connection: the session state is discarded
+    before every statement that runs outside a transaction.
+    """
+    if not context['connection'].in_atomic_block:
+        execute('DISCARD ALL', None, False, context)
+    return execute(sql, params, many, context)
+
+
+@override_settings(SENSORATLAS={
+    'TRANSACTION_POOLING': True,
+    'PREPARE_THRESHOLD': 0,
+    'ITERATOR_CHUNK_SIZE': 2
+})
+class TransactionPooling(APITransactionTestCase):
+    """
+    Check that requests keep no state in the database session between
+    transactions when TRANSACTION_POOLING is enabled.
+    """
+    def setUp(self):
+        """
+        Create test resources
+        """
+        location = Location.objects.create(
+            name='Location 1',
+            description='This is a location',
+            encodingType='application/vnd.geo+json',
+            location=Point(-114.133, 51.08, srid=4326)
+            )
+        feature = FeatureOfInterest.objects.create(
+            name='Usidore',
+            description='this is a place',
+            encodingType='application/vnd.geo+json',
+            feature=Polygon(((0.0, 0.0),
+                             (0.0, 50.0),
+                             (50.0, 50.0),
+                             (50.0, 0.0),
+                             (0.0, 0.0))
+                            ))
+        sensor = Sensor.objects.create(
+            name='Temperature Sensor',
+            description='This is a sensor test',
+            encodingType='PDF',
+            metadata='This is some very descriptive metadata.'
+            )
+        observedproperty = ObservedProperty.objects.create(
+            name='Temperature',
+            definition='https://wikipedia.org',
+            description='This is a test'
+            )
+        for i in range(1, 6):
+            thing = Thing.objects.create(
+                name='Thing ' + str(i),
+                description='This is a thing',
+                properties={}
+                )
+            thing.Location.add(location)
+        datastream = Datastream.objects.create(
+            name='Chunt',
+            description='Bing Bong',
+            observationType="http://www.opengis.net/def/observationType/OGC-OM/2.0/OM_Measurement",
+            unitOfMeasurement={},
+            Thing=thing,
+            Sensor=sensor,
+            ObservedProperty=observedproperty
+            )
+        for i, result in enumerate([42, 3, 15.7, 23, 8]):
+            Observation.objects.create(
+                phenomenonTime="2019-02-07T19:0%d:00+00:00" % i,
+                result=result,
+                Datastream=datastream,
+                FeatureOfInterest=feature
+                )
+        statement_cache.clear()
+
+    def test_filter_annotations(self):
+        point = "geography'SRID=4326;POINT(-114.133 51.08)'"
+        queries = [
+            ('Observations', '$filter=result mul 2 gt 40', 2),
+            ('Observations', '$filter=round(result) eq 16', 1),
+            ('Observations', '$filter=result mul 2 gt 40 and round(result) eq 42', 1),
+            ('Locations', '$filter=geo.distance(location, %s) le 1' % point, 1),
+            ('Locations', '$filter=geo.distance(location, %s) gt 1' % point, 0),
+        ]
+        with connection.execute_wrapper(discard_session):
+            for _ in range(2):
+                for entity, query, count in queries:
+                    response = self.client.get('/api/v1.0/%s?%s' % (entity, query))
+                    self.assertEqual(response.status_code, status.HTTP_200_OK)
+                    self.assertEqual(len(response.data['value']), count)
+        self.assertEqual(statement_cache.cache_info()['prepares'], 0)
+
+    def test_unpaginated_chunks(self):
+        with connection.execute_wrapper(discard_session), \
+                mock.patch.object(SensorThingsPagination, 'default_limit', None):
+            response = self.client.get('/api/v1.0/Things?$expand=Locations')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            things = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(len(things), 5)
+        self.assertEqual(things[4]['Locations'][0]['name'], 'Location 1')
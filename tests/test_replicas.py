@@ -0,0 +1,65 @@
+from rest_framework import status
+from rest_framework.reverse import reverse
+from rest_framework.test import APITestCase
+from django.core.cache import cache
+from django.test import override_settings
+from sensorAtlas import replicas
+from sensorAtlas.models import Thing
+from sensorAtlas.replicas import ReplicaRouter
+from unittest import mock
+
+
+@override_settings(
+    DATABASE_ROUTERS=['sensorAtlas.replicas.ReplicaRouter'],
+    # the test database stands in for the replica
+    SENSORATLAS={'READ_REPLICAS': ['default'], 'REPLICA_PIN_SECONDS': 5}
+)
+class ReadReplicas(APITestCase):
+    """
+    Check that GET requests read from a replica and that clients that wrote
+    read from the primary for a while.
+    """
+    def setUp(self):
+        cache.clear()
+        Thing.objects.create(
+            name='Thing 1',
+            description='This is a thing',
+            properties={}
+            )
+
+    def get(self, url):
+        databases = []
+
+        def db_for_read(router, model, **hints):
+            databases.append(replicas.read_database())
+            return databases[-1]
+        with mock.patch.object(ReplicaRouter, 'db_for_read', db_for_read):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return set(databases)
+
+    def test_reads(self):
+        thing = Thing.objects.get()
+        for url in ('/api/v1.0/Things',
+                    '/api/v1.0/Things(%d)' % thing.id,
+                    '/api/v1.0/Things(%d)/name' % thing.id):
+            self.assertEqual(self.get(url), {'default'})
+        self.assertEqual(ReplicaRouter().db_for_write(Thing), 'default')
+
+    def test_pinned_after_write(self):
+        data = {
+            "name": "Thing 2",
+            "description": "This is a thing",
+            "properties": {}
+        }
+        url = reverse('thing-list', kwargs={'version': 'v1.0'})
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.get('/api/v1.0/Things'), {None})
+        # other clients behind the same address still read from the replica
+        writer = self.client
+        self.client = self.client_class()
+        self.assertEqual(self.get('/api/v1.0/Things'), {'default'})
+        self.client = writer
+        self.client.cookies.clear()
+        self.assertEqual(self.get('/api/v1.0/Things'), {'default'})
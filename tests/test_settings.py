@@ -63,5 +63,9 @@ REST_FRAMEWORK = {
     'ORDERING_PARAM': '$orderby',
     'DEFAULT_PAGINATION_CLASS': 'sensorAtlas.pagination.SensorThingsPagination',
     'PAGE_SIZE': 100,
+    'DEFAULT_RENDERER_CLASSES': (
+        'sensorAtlas.renderers.SensorThingsJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
     'TEST_REQUEST_DEFAULT_FORMAT': 'json'
 }
@@ -0,0 +1,44 @@
+from rest_framework.test import APITestCase
+from django.conf import settings
+from django.db import connection
+from django.test import override_settings
+from sensorAtlas.models import Thing
+from sensorAtlas.statements import check_persistent_connections, \
+    prepared_statements, statement_cache
+
+
+@override_settings(SENSORATLAS={'PREPARE_THRESHOLD': 1})
+class PreparedStatements(APITestCase):
+    """
+    Check that repeated SELECT statements are run as prepared statements
+    when PREPARE_THRESHOLD is set.
+    """
+    def setUp(self):
+        self.thing = Thing.objects.create(
+            name='Thing 1',
+            description='This is a thing',
+            properties={}
+            )
+        statement_cache.clear()
+
+    def test_prepared_statements(self):
+        url = '/api/v1.0/Things(%d)' % self.thing.id
+        responses = [self.client.get(url).data for _ in range(3)]
+        self.assertEqual(responses[0], responses[2])
+        info = statement_cache.cache_info()
+        self.assertGreaterEqual(info['prepares'], 1)
+        self.assertGreaterEqual(info['prepared_executions'], 1)
+        names = {row['name'] for row in prepared_statements(connection)}
+        self.assertTrue(any(
+            shape['name'] in names
+            for shape in statement_cache.shapes() if shape['prepares']
+        ))
+
+    def test_persistent_connections_check(self):
+        databases = {'default': dict(settings.DATABASES['default'], CONN_MAX_AGE=0)}
+        with override_settings(DATABASES=databases):
+            warnings = check_persistent_connections(None)
+        self.assertEqual([warning.id for warning in warnings], ['sensorAtlas.W001'])
+        databases['default']['CONN_MAX_AGE'] = 60
+        with override_settings(DATABASES=databases):
+            self.assertEqual(check_persistent_connections(None), [])
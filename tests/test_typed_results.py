@@ -0,0 +1,137 @@
+from rest_framework import status
+from rest_framework.test import APITestCase
+from django.db import connection
+from django.test import override_settings
+from sensorAtlas.models import Thing, Location, Datastream, Sensor, \
+    ObservedProperty, Observation, FeatureOfInterest
+from sensorAtlas.parsers import parser
+from django.contrib.gis.geos import Point, Polygon
+
+
+@override_settings(SENSORATLAS={'TYPED_RESULTS': True})
+class TypedResults(APITestCase):
+    """
+    Check that Observation results are stored in the typed result columns
+    and that $filter queries them when TYPED_RESULTS is enabled.
+    """
+    def setUp(self):
+        """
+        Create test resources
+        """
+        location = Location.objects.create(
+            name='Location 1',
+            description='This is a location',
+            encodingType='application/vnd.geo+json',
+            location=Point(-114.133, 51.08, srid=4326)
+            )
+        thing = Thing.objects.create(
+            name='Thing 1',
+            description='This is a thing',
+            properties={}
+            )
+        thing.Location.add(location)
+        feature = FeatureOfInterest.objects.create(
+            name='Usidore',
+            description='this is a place',
+            encodingType='application/vnd.geo+json',
+            feature=Polygon(((0.0, 0.0),
+                             (0.0, 50.0),
+                             (50.0, 50.0),
+                             (50.0, 0.0),
+                             (0.0, 0.0))
+                            ))
+        sensor = Sensor.objects.create(
+            name='Temperature Sensor',
+            description='This is a sensor test',
+            encodingType='PDF',
+            metadata='This is some very descriptive metadata.'
+            )
+        observedproperty = ObservedProperty.objects.create(
+            name='Temperature',
+            definition='https://wikipedia.org',
+            description='This is a test'
+            )
+        measurement = Datastream.objects.create(
+            name='Chunt',
+            description='Bing Bong',
+            observationType="http://www.opengis.net/def/observationType/OGC-OM/2.0/OM_Measurement",
+            unitOfMeasurement={},
+            Thing=thing,
+            Sensor=sensor,
+            ObservedProperty=observedproperty
+            )
+        anything = Datastream.objects.create(
+            name='Spintax',
+            description='The Green',
+            observationType="http://www.opengis.net/def/observationType/OGC-OM/2.0/OM_Observation",
+            unitOfMeasurement={},
+            Thing=thing,
+            Sensor=sensor,
+            ObservedProperty=observedproperty
+            )
+        for i, result in enumerate([42, 3, 15.7, 23]):
+            Observation.objects.create(
+                phenomenonTime="2019-02-07T19:0%d:00+00:00" % i,
+                result=result,
+                Datastream=measurement,
+                FeatureOfInterest=feature
+                )
+        Observation.objects.create(
+            phenomenonTime="2019-02-07T19:06:00+00:00",
+            result='Truth',
+            Datastream=anything,
+            FeatureOfInterest=feature
+            )
+
+    def test_typed_columns(self):
+        number = Observation.objects.get(result__result=42)
+        self.assertEqual(number.result_number, 42.0)
+        self.assertIsNone(number.result_text)
+        text = Observation.objects.get(result__result='Truth')
+        self.assertEqual(text.result_text, 'Truth')
+        self.assertIsNone(text.result_number)
+
+    def test_filter_number(self):
+        query = '$filter=result gt 20'
+        response = self.client.get('/api/v1.0/Observations?' + query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['value']), 2)
+
+    def test_filter_text(self):
+        query = "$filter=result eq 'Truth'"
+        response = self.client.get('/api/v1.0/Observations?' + query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['value']), 1)
+        self.assertEqual(response.data['value'][0]['result'], 'Truth')
+
+    def test_filter_not_equal(self):
+        query = "$filter=result ne 'Truth'"
+        response = self.client.get('/api/v1.0/Observations?' + query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['value']), 4)
+
+    def test_filter_round(self):
+        query = '$filter=round(result) eq 16'
+        response = self.client.get('/api/v1.0/Observations?' + query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['value']), 1)
+        self.assertEqual(response.data['value'][0]['result'], 15.7)
+
+    def test_result_indexes(self):
+        # the expressions the filters compare the result with are indexed
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        observations = Observation.objects.all()
+        self.assertIn('observation_result_text',
+                      parser("result eq 'Truth'", observations).explain())
+        filters = [
+            ("result eq 'Truth'", 'observation_result_value', 1),
+            ('round(result) eq 16', 'observation_result_round', 1),
+            ('floor(result) eq 15', 'observation_result_floor', 1),
+            ('ceiling(result) eq 16', 'observation_result_ceiling', 1),
+        ]
+        with override_settings(SENSORATLAS={'TYPED_RESULTS': False}):
+            for query, index, count in filters:
+                queryset = parser(query, observations)
+                self.assertIn(index, queryset.explain())
+                self.assertEqual(queryset.count(), count)